@@ -1,9 +1,12 @@
-# This script downsamples a LiDAR point cloud (LAS format) for a factor of 5 (can be changed in scripts).
-# It outputs the corresponding downsampled LAS files of the input files. 
+# This script downsamples a LiDAR point cloud (LAS format) for a factor of 5 (can be changed in scripts) or to a target density.
+# It outputs the corresponding downsampled LAS files of the input files. The files are read and written by chunks.
 
 import os, sys
 import laspy
+import numpy as np
 from loguru import logger
+from joblib import Parallel, delayed
+from tqdm import tqdm
 
 sys.path.insert(1, 'scripts')
 import functions.fct_misc as fct_misc
@@ -19,23 +22,79 @@ os.chdir(WORKING_DIR)
 
 PATH_IN = "01_initial/lidar_point_cloud/original"
 PATH_OUT = fct_misc.ensure_dir_exists("02_intermediate/lidar_point_cloud/downsampled")
+
+MODE = "factor"         # "factor" to keep one point out of FACTOR, "random" or "grid" to reach the TARGET_DENSITY
+FACTOR = 5
+TARGET_DENSITY = 10     # pts/m2
+SEED = 42               # seed of the "random" mode
+CHUNK_SIZE = 5000000    # number of points read at once
+N_JOBS = os.cpu_count() # number of files processed in parallel
  
 ################################################################################
 
-def main(path_in, path_out, files_name):
+def downsample_file(las_in, las_out, mode='factor', factor=5, target_density=10, seed=42, chunk_size=5000000):
+    '''
+    Downsample a LAS file chunk by chunk, so that the point cloud is never loaded whole.
+
+    - las_in: path to the LAS file
+    - las_out: path to the downsampled LAS file
+    - mode: "factor" to keep one point out of factor, "random" to keep each point with the probability giving the 
+        target density, "grid" to keep the first point in each cell of a grid with the size giving the target density
+    - factor: downsampling factor of the "factor" mode
+    - target_density: density in pts/m2 of the "random" and "grid" modes
+    - seed: seed of the "random" mode
+    - chunk_size: number of points read at once
+    return: the number of points kept.
+    '''
+
+    with laspy.open(las_in) as reader, laspy.open(las_out, mode='w', header=reader.header) as writer:
+        header = reader.header
+        area = (header.maxs[0] - header.mins[0])*(header.maxs[1] - header.mins[1])
+
+        if mode == 'random':
+            rng = np.random.default_rng(seed)
+            probability = min(target_density*area/header.point_count, 1) if header.point_count > 0 else 1
+        elif mode == 'grid':
+            cell_size = 1/np.sqrt(target_density)
+            nbr_cols = int(np.floor((header.maxs[0] - header.mins[0])/cell_size)) + 1
+            nbr_rows = int(np.floor((header.maxs[1] - header.mins[1])/cell_size)) + 1
+            occupied_cells = np.zeros(nbr_cols*nbr_rows, dtype=bool)
+        elif mode != 'factor':
+            raise ValueError(f'The mode {mode} is not supported. Only "factor", "random" and "grid" are.')
+
+        nbr_read_points = 0
+        nbr_kept_points = 0
+        for points in reader.chunk_iterator(chunk_size):
+            if mode == 'factor':
+                # The stride continues from one chunk to the next, as for the whole point cloud.
+                kept_points = np.arange((-nbr_read_points) % factor, len(points), factor)
+            elif mode == 'random':
+                kept_points = rng.random(len(points)) < probability
+            else:
+                cols = np.clip(np.floor((points.x - header.mins[0])/cell_size).astype(int), 0, nbr_cols-1)
+                rows = np.clip(np.floor((points.y - header.mins[1])/cell_size).astype(int), 0, nbr_rows-1)
+                cells = rows*nbr_cols + cols
+                new_cells, first_points = np.unique(cells, return_index=True)
+                first_points = first_points[~occupied_cells[new_cells]]
+                occupied_cells[cells[first_points]] = True
+                kept_points = np.sort(first_points)
+
+            writer.write_points(points[kept_points])
+            nbr_read_points += len(points)
+            nbr_kept_points += len(points[kept_points])
+
+    return nbr_kept_points
 
-    factor = 5
-    
-    for _name in files_name:
-        _las = os.path.join(path_in, _name)
 
-        with laspy.open(_las) as fh:
-            # Read las data
-            las = fh.read()
-        tree_seg = laspy.LasData(las.header)
-        tree_seg.points = las.points[::factor].copy()
+def main(path_in, path_out, files_name):
+
+    kept_points = Parallel(n_jobs=N_JOBS, return_as='generator')(
+        delayed(downsample_file)(os.path.join(path_in, _name), os.path.join(path_out, _name), MODE, FACTOR, TARGET_DENSITY, SEED, CHUNK_SIZE)
+        for _name in files_name
+    )
+    nbr_kept_points = sum(tqdm(kept_points, desc='Downsampling files', total=len(files_name)))
 
-        tree_seg.write(os.path.join(path_out, _name)) 
+    logger.info(f'{nbr_kept_points} points were kept.')
 
 
 if __name__ == "__main__":
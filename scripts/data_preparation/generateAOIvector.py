@@ -1,14 +1,12 @@
 import os, sys
-import numpy as np
-import pandas as pd
 import geopandas as gpd
 import rasterio
-from rasterio.mask import mask
 from rasterio.features import shapes
+from rasterio.enums import MaskFlags
 
-from rasterio.features import dataset_features
-
-from shapely.geometry import mapping, shape
+from shapely.geometry import shape, box
+from shapely.ops import unary_union
+from joblib import Parallel, delayed
 
 sys.path.insert(1, 'scripts')
 import functions.fct_misc as fct_misc
@@ -25,27 +23,55 @@ PATH_IN = "01_initial/true_orthophoto/original/tiles"
 PATH_OUT = fct_misc.ensure_dir_exists("02_intermediate/AOI")
 fct_misc.ensure_dir_exists("02_intermediate/AOI/tiles") 
 
+N_JOBS = os.cpu_count()     # number of processes for the tiles whose valid data must be polygonized
+WRITE_TILE_SHAPEFILES = True    # also write one shapefile per tile, as used by FHI_catalog.R
+
 ################################################################################
 
+def get_valid_footprint(tif):
+    '''
+    Polygonize the valid data mask of the second band of a tile.
+
+    - tif: path to the tile
+    return: the footprint of the valid data as a shapely geometry.
+    '''
+
+    with rasterio.open(tif) as src:
+        valid_mask = src.read_masks(2)
+        valid_parts = [shape(geom) for geom, _ in shapes(valid_mask, mask=valid_mask > 0, transform=src.transform)]
+
+    return unary_union(valid_parts)
+
+
 def main(path_in, files_name):
     
-    aoi_merge=gpd.GeoDataFrame()
-    for _name in files_name:
-
-        _tif = os.path.join(path_in, _name)
+    tifs = [os.path.join(path_in, _name) for _name in files_name]
 
+    # Footprint from the header when all the pixels are valid, otherwise the valid data mask must be polygonized
+    footprints = []
+    to_polygonize = []
+    for i, _tif in enumerate(tifs):
         with rasterio.open(_tif) as src:
-            gdf = gpd.GeoDataFrame.from_features(dataset_features(src, bidx=2, as_mask=True, geographic=False, band=False))
-            gdf.set_crs(crs=src.crs, inplace=True)
-            gdf.filename=_name.replace('.tif', '')
-            gdf.to_file(os.path.join(PATH_OUT,'tiles',_name.replace('.tif', '.shp')))
-            aoi_merge = pd.concat([aoi_merge, gpd.GeoDataFrame(gdf, index=[0])], ignore_index=True)
-            src.close()
-
-    aoi_merge=aoi_merge.drop(columns= ['val'])
-    aoi_merge=aoi_merge.rename(columns={"filename":"NAME"})
-    aoi_merge.to_file(os.path.join(PATH_OUT, 'AOI.shp'))
-    # merge the shp files to have all tiles together. name tile in attribute. 
+            crs = src.crs
+            if MaskFlags.all_valid in src.mask_flag_enums[1]:
+                footprints.append(box(*src.bounds))
+            else:
+                footprints.append(None)
+                to_polygonize.append(i)
+
+    if to_polygonize:
+        valid_footprints = Parallel(n_jobs=N_JOBS)(delayed(get_valid_footprint)(tifs[i]) for i in to_polygonize)
+        for i, footprint in zip(to_polygonize, valid_footprints):
+            footprints[i] = footprint
+
+    aoi_merge = gpd.GeoDataFrame({'NAME': [_name.replace('.tif', '') for _name in files_name]}, geometry=footprints, crs=crs)
+    # The GeoPackage is written with a spatial index. It is not read by the other scripts, but gives the valid data
+    # footprint of all the tiles, e.g. to check the coverage of the AOI in a GIS.
+    aoi_merge.to_file(os.path.join(PATH_OUT, 'AOI.gpkg'), layer='AOI', driver='GPKG')
+
+    if WRITE_TILE_SHAPEFILES:
+        for tile in aoi_merge.itertuples():
+            aoi_merge.loc[[tile.Index]].to_file(os.path.join(PATH_OUT, 'tiles', tile.NAME + '.shp'))
 
 
 if __name__ == "__main__":
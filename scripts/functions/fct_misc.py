@@ -1,16 +1,28 @@
 import sys
 import os
+import warnings
+from collections import OrderedDict
 
+import fiona
 import geopandas as gpd
 import pandas as pd
+import shapely
 from shapely.geometry import mapping, shape
+from shapely.geometry.base import BaseGeometry
 from shapely.affinity import scale
 
 import rasterio
-from rasterio.mask import mask
-from rasterio.features import shapes
+from rasterio.features import shapes, geometry_mask, rasterize
+from rasterio.windows import Window, from_bounds
+from rasterio.enums import Resampling
 
 import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from joblib import Parallel, delayed
+
+# Rasters kept open in the current process by get_raster
+OPEN_RASTERS=OrderedDict()
 
 
 def format_logger(logger):
@@ -54,69 +66,103 @@ def ensure_dir_exists(dirpath):
     return dirpath
 
 
-def get_pixel_values(geoms, tile, bands = range(1,4), pixel_values = pd.DataFrame(), **kwargs):
+def get_pixel_values(geoms, tile, bands = range(1,4), pixel_values = pd.DataFrame(), chm_path = None, **kwargs):
     '''
-    Extract the value of the raster pixels falling under the mask and save them in a dataframe.
-    cf https://gis.stackexchange.com/questions/260304/extract-raster-values-within-shapefile-with-pygeoprocessing-or-gdal
+    Extract the value of the raster pixels falling under the geometries of a tile and save them in a dataframe.
+    All the geometries are rasterized in a label image over their common window, which is read once, and the pixels
+    are gathered per label. Overlapping geometries are rasterized in separate layers, so that a pixel can belong to 
+    several geometries.
 
-    - geoms: list of shapely geometries determining the zones where the pixels are extracted
+    - geoms: shapely geometry or list of shapely geometries determining the zones where the pixels are extracted
     - tile: path to the raster image
     - bands: bands of the tile
     - pixel_values: dataframe to which the values for the pixels are going to be concatenated
-    - kwargs: additional arguments we would like to pass the dataframe of the pixels
+    - chm_path: path to a binary CHM. If given, only the pixels where the CHM is equal to 1 are kept (cf. get_height_mask).
+    - kwargs: additional arguments we would like to pass the dataframe of the pixels, either one value for all the
+        geometries or one value per geometry
 
     return: a dataframe with the pixel values on each band and the keyworded arguments.
     '''
     
-    # extract the geometry in GeoJSON format
-    geoms_list = [mapping(geoms)]
+    if isinstance(geoms, BaseGeometry):
+        geoms=[geoms]
+    geoms=list(geoms)
+    bands=list(bands)
 
-    # extract the raster values values within the polygon 
     with rasterio.open(tile) as src:
-        # test_crs(geoms.crs, src.crs)
-        # print('Same crs')
-        out_image, _ = mask(src, geoms_list, crop=True)
-        # out_image, _ = mask(src, geoms_list, crop=True, filled=False)
-
-        # no data values of the original raster
-        no_data=src.nodata
+        window=get_window(shapely.total_bounds(geoms), src)
+        image=src.read(bands, window=window)
+        window_transform=src.window_transform(window)
+
+        # We consider that the nodata values are 0 when they are not defined.
+        no_data=src.nodata if src.nodata is not None else 0
+
+    image=image.reshape(len(bands), -1)
+    pixels_idx=[]
+    geoms_idx=[]
+    for layer in get_non_overlapping_layers(geoms):
+        if image.shape[1]==0:
+            break
+        labels=rasterize([(geoms[i], i+1) for i in layer], out_shape=(window.height, window.width),
+                         transform=window_transform, fill=0, dtype='uint32').ravel()
+        layer_pixels=np.flatnonzero(labels)
+        pixels_idx.append(layer_pixels)
+        geoms_idx.append(labels[layer_pixels]-1)
     
-    dico={}
-    length_bands=[]
-    for band in bands:
+    pixels_idx=np.concatenate(pixels_idx) if pixels_idx else np.array([], dtype=int)
+    geoms_idx=np.concatenate(geoms_idx) if geoms_idx else np.array([], dtype=int)
+
+    # Order the pixels by geometry and remove the no data pixels, i.e. with the no data value on all the bands
+    order=np.argsort(geoms_idx, kind='stable')
+    pixels_idx=pixels_idx[order]
+    geoms_idx=geoms_idx[order]
+    valid_pixels=~(image[:, pixels_idx]==no_data).all(axis=0)
+    if chm_path and pixels_idx.size > 0:
+        valid_pixels&=get_height_mask(chm_path, window_transform, (window.height, window.width)).ravel()[pixels_idx]
+    pixels_idx=pixels_idx[valid_pixels]
+    geoms_idx=geoms_idx[valid_pixels]
+
+    dico={f'band{band}': image[i, pixels_idx] for i, band in enumerate(bands)}
+    for key, value in kwargs.items():
+        dico[key]=np.asarray(value)[geoms_idx] if np.ndim(value) > 0 else value
 
-        # extract the values of the masked array
-        data = out_image[band-1]
-
-        # extract the the valid values
-        val = np.extract(data != no_data, data)
+    pixels_from_tile = pd.DataFrame(dico)
 
-        dico[f'band{band}']=val
-        length_bands.append(len(val))
+    if not pixel_values.empty:
+        pixels_from_tile = pd.concat([pixel_values, pixels_from_tile], ignore_index=True)
 
-    max_length=max(length_bands)
+    return pixels_from_tile
 
-    for band in bands:
 
-        if length_bands[band-1] < max_length:
+def get_non_overlapping_layers(geoms):
+    '''
+    Split the geometries in layers where none of them overlaps another one.
 
-            fill=[no_data]*max_length
-            dico[f'band{band}']=np.append(dico[f'band{band}'], fill[length_bands[band-1]:])
+    - geoms: list of shapely geometries
+    return: a list of layers, each given as a list of indices of the geometries.
+    '''
 
-            print(f'{max_length-length_bands[band-1]} pixels was/were missing on the band {band} on the tile {tile[-18:]} and' +
-                        f' got replaced with the value used of no data ({no_data}).')
+    tree=shapely.STRtree(geoms)
+    intersecting=tree.query(geoms, predicate='intersects')
+    touching=tree.query(geoms, predicate='touches')
+    intersecting_pairs=set(zip(*intersecting)) - set(zip(*touching))
 
-    dico.update(**kwargs)
-    pixels_from_tile = pd.DataFrame(dico)
+    neighbours={i: set() for i in range(len(geoms))}
+    for i, j in intersecting_pairs:
+        if i!=j:
+            neighbours[i].add(j)
+            neighbours[j].add(i)
 
-    # We consider that the nodata values are where the value is 0 on each band
-    if no_data is None:
-        subset=pixels_from_tile[[f'band{band}' for band in bands]]
-        pixels_from_tile = pixels_from_tile.drop(pixels_from_tile[subset.apply(lambda x: (max(x) == 0), 1)].index)
+    layer_of_geom={}
+    for i in range(len(geoms)):
+        used_layers={layer_of_geom[j] for j in neighbours[i] if j in layer_of_geom}
+        layer_of_geom[i]=min(set(range(len(used_layers)+1)) - used_layers)
 
-    pixel_values = pd.concat([pixel_values, pixels_from_tile],ignore_index=True)
+    layers=[[] for _ in range(max(layer_of_geom.values(), default=-1)+1)]
+    for i, layer in layer_of_geom.items():
+        layers[layer].append(i)
 
-    return pixel_values
+    return layers
 
 
 def polygons_diff_without_artifacts(polygons, p1_idx, p2_idx, keep_everything=False):
@@ -204,21 +250,111 @@ def test_valid_geom(poly_gdf, correct=False, gdf_obj_name=None):
     return poly_gdf
 
 
-def polygonize_binary_raster(path):
+def polygonize_window(path, window):
+    '''
+    Polygonize the pixels equal to 1 in a window of a binary raster.
+
+    - path: path to the binary raster
+    - window: rasterio window to polygonize
+    return: an array of the polygons and a boolean array indicating the polygons touching a side of the window which is
+        not a side of the raster, i.e. which may continue in the neighbouring window.
+    '''
+
+    with rasterio.open(path) as src:
+        image=src.read(1, window=window)
+        transform=src.window_transform(window)
+        raster_width, raster_height=src.width, src.height
+
+    geoms=np.array([shape(s) for s, _ in shapes(image, image==1, transform=transform)], dtype=object)
+    if len(geoms)==0:
+        return geoms, np.zeros(0, dtype=bool)
+
+    # Sides of the window shared with a neighbouring window, with a tolerance of half a pixel
+    minx, miny, maxx, maxy=shapely.bounds(geoms).T
+    left, top=transform.c, transform.f
+    right, bottom=transform*(window.width, window.height)
+    half_x, half_y=abs(transform.a)/2, abs(transform.e)/2
+    on_seam=np.zeros(len(geoms), dtype=bool)
+    if window.col_off > 0:
+        on_seam|=minx < left + half_x
+    if window.col_off + window.width < raster_width:
+        on_seam|=maxx > right - half_x
+    if window.row_off > 0:
+        on_seam|=maxy > top - half_y
+    if window.row_off + window.height < raster_height:
+        on_seam|=miny < bottom + half_y
+
+    return geoms, on_seam
+
+
+def dissolve_seams(geoms):
+    '''
+    Merge the polygons sharing a side, like the polygons cut by the seams between windows.
+    Polygons touching only at a corner are not merged, as for the pixels in rasterio.features.shapes.
+
+    - geoms: array of polygons
+    return: an array of the merged polygons.
+    '''
+
+    if len(geoms)==0:
+        return geoms
+
+    first, second=shapely.STRtree(geoms).query(geoms, predicate='touches')
+    # Keep the pairs whose boundaries share a line (dimension 1 in the DE-9IM matrix)
+    sharing_side=shapely.relate_pattern(geoms[first], geoms[second], '****1****')
+    graph=coo_matrix((np.ones(sharing_side.sum()), (first[sharing_side], second[sharing_side])), shape=(len(geoms), len(geoms)))
+    _, groups=connected_components(graph, directed=False)
+
+    order=np.argsort(groups, kind='stable')
+    splits=np.flatnonzero(np.diff(groups[order])) + 1
+    
+    return np.array([shapely.union_all(group) if len(group) > 1 else group[0] for group in np.split(geoms[order], splits)], dtype=object)
+
+
+def polygonize_binary_raster(path, window_size=None, n_jobs=1, output_path=None):
     '''
     Get a binary raster and return a dataframe of the zones equal to 1.
+    With a window size, the raster is polygonized window by window in parallel and the polygons cut by the seams 
+    between windows are merged at the end. With an output path, the polygons are written to the file as the windows
+    are processed instead of being kept in memory.
 
     -path: path to the binary raster.
-    return: a dataframe of the pixels equal to 1 aggregated into polygons.
+    -window_size: size in pixels of the windows. If None, the raster is polygonized in one piece.
+    -n_jobs: number of processes for the windows
+    -output_path: path to a GeoPackage (.gpkg) or FlatGeobuf (.fgb) file for the polygons
+    return: a dataframe of the pixels equal to 1 aggregated into polygons or the output path if one is given.
     '''
 
     with rasterio.open(path) as src:
-        image=src.read(1)
-
-        mask= image==1
-        geoms = ((shape(s), v) for s, v in shapes(image, mask, transform=src.transform))
-        gdf=gpd.GeoDataFrame(geoms, columns=['geometry', 'class'])
-        gdf.set_crs(crs=src.crs, inplace=True)
+        crs=src.crs
+        width, height=src.width, src.height
+
+    window_size=window_size if window_size else max(width, height)
+    windows=[Window(col_off, row_off, min(window_size, width-col_off), min(window_size, height-row_off))
+             for row_off in range(0, height, window_size) for col_off in range(0, width, window_size)]
+
+    if output_path:
+        driver='FlatGeobuf' if output_path.endswith('.fgb') else 'GPKG'
+        dst=fiona.open(output_path, 'w', driver=driver, crs_wkt=crs.to_wkt(),
+                       schema={'geometry': 'Polygon', 'properties': {'class': 'float'}})
+        write=lambda geoms: dst.writerecords({'geometry': mapping(geom), 'properties': {'class': 1.0}} for geom in geoms)
+    else:
+        polygons=[]
+        write=polygons.append
+
+    seam_polygons=[]
+    for geoms, on_seam in Parallel(n_jobs=n_jobs, return_as='generator')(delayed(polygonize_window)(path, window)
+                                                                        for window in windows):
+        write(geoms[~on_seam])
+        seam_polygons.append(geoms[on_seam])
+    write(dissolve_seams(np.concatenate(seam_polygons)))
+
+    if output_path:
+        dst.close()
+        return output_path
+
+    geoms=np.concatenate(polygons)
+    gdf=gpd.GeoDataFrame({'class': np.ones(len(geoms))}, geometry=geoms, crs=crs)
 
     return gdf
 
@@ -235,25 +371,34 @@ def clip_labels(labels_gdf, tiles_gdf, fact=1):
     return: a geodataframe with the labels clipped to the tiles
     '''
 
-    tiles_gdf['tile_geometry'] = tiles_gdf['geometry']
-        
     assert(labels_gdf.crs.name == tiles_gdf.crs.name)
-    
-    labels_tiles_sjoined_gdf = gpd.sjoin(labels_gdf, tiles_gdf, how='inner', predicate='intersects')
-    
-    def clip_row(row, fact=fact):
-        
-        old_geo = row.geometry
-        scaled_tile_geo = scale(row.tile_geometry, xfact=fact, yfact=fact)
-        new_geo = old_geo.intersection(scaled_tile_geo)
-        row['geometry'] = new_geo
 
-        return row
+    # Pairs of intersecting labels and tiles, as positions in the frames and in the order of the labels
+    label_positions, tile_positions = tiles_gdf.sindex.query(labels_gdf.geometry.values, predicate='intersects')
 
-    clipped_labels_gdf = labels_tiles_sjoined_gdf.apply(lambda row: clip_row(row, fact), axis=1)
-    clipped_labels_gdf.crs = labels_gdf.crs
+    # Attributes of the tiles, with the same suffixes as gpd.sjoin for the columns present in both frames
+    tile_attributes = pd.DataFrame(tiles_gdf.drop(columns=tiles_gdf.geometry.name))
+    common_columns = labels_gdf.columns.intersection(tile_attributes.columns)
+    tile_attributes = tile_attributes.rename(columns={column: column + '_right' for column in common_columns})
+
+    clipped_labels_gdf = labels_gdf.iloc[label_positions].rename(columns={column: column + '_left' for column in common_columns})
+    labels_index = clipped_labels_gdf.index
+    clipped_labels_gdf = clipped_labels_gdf.reset_index(drop=True).join(tile_attributes.iloc[tile_positions].reset_index(drop=True))
+    clipped_labels_gdf.index = labels_index
+
+    tile_geometries = tiles_gdf.geometry.to_numpy()
+    if fact != 1:
+        tile_geometries = np.array([scale(geom, xfact=fact, yfact=fact) for geom in tile_geometries])
+    shapely.prepare(tile_geometries)
+    tile_geometries = tile_geometries[tile_positions]
+    label_geometries = labels_gdf.geometry.to_numpy()[label_positions]
+
+    # Only the labels which are not completely in the tile need to be intersected
+    to_clip = ~shapely.covers(tile_geometries, label_geometries)
+    label_geometries[to_clip] = shapely.intersection(label_geometries[to_clip], tile_geometries[to_clip])
+
+    clipped_labels_gdf['geometry'] = gpd.GeoSeries(label_geometries, index=labels_index, crs=labels_gdf.crs)
 
-    clipped_labels_gdf.drop(columns=['tile_geometry', 'index_right'], inplace=True)
     clipped_labels_gdf.rename(columns={'id': 'tile_id'}, inplace=True)
 
     return clipped_labels_gdf
@@ -284,4 +429,313 @@ def get_ortho_tiles(tiles, folder_path_in, folder_path_out, working_dir=None):
     tiles['path_RGB']=rgb_pathes
     tiles['path_NDVI']=ndvi_pathes
 
-    return tiles
\ No newline at end of file
+    return tiles
+
+
+def get_raster_metadata(path):
+    '''
+    Get the metadata of a raster from its header, without reading the pixels.
+
+    - path: path to the raster
+    return: a dictionary with the footprint, transform, resolution, size, number of bands, data type and no data value
+        of the raster, and its crs.
+    '''
+
+    with rasterio.open(path) as src:
+        metadata={
+            'geometry': shapely.box(*src.bounds),
+            'transform': ','.join(str(coef) for coef in tuple(src.transform)[:6]),
+            'res_x': src.res[0], 'res_y': src.res[1],
+            'width': src.width, 'height': src.height,
+            'count': src.count, 'dtype': src.dtypes[0], 'nodata': src.nodata,
+        }
+        crs=src.crs
+
+    return metadata, crs
+
+
+def build_tile_catalog(tile_paths, products={}, chm_paths=[], n_jobs=1):
+    '''
+    Build the catalog of the tiles from the headers of the rasters, read in parallel.
+    The name of a tile is the name of its file and the paths to the products derived from the tile are deduced from it.
+
+    - tile_paths: paths to the original tiles
+    - products: dictionary with the name of each product as key and the directory and suffix of its files as value
+    - chm_paths: paths to the CHM mosaics, each tile is attributed the one overlapping it the most
+    - n_jobs: number of processes
+    return: a geodataframe with the footprint, metadata and paths of each tile.
+    '''
+
+    tile_paths=[tile_path.replace('\\', '/') for tile_path in tile_paths] # handle windows path
+    tiles_metadata=Parallel(n_jobs=n_jobs)(delayed(get_raster_metadata)(tile_path) for tile_path in tile_paths)
+
+    catalog=gpd.GeoDataFrame([metadata for metadata, _ in tiles_metadata], geometry='geometry', crs=tiles_metadata[0][1])
+    catalog.insert(0, 'NAME', [os.path.splitext(os.path.basename(tile_path))[0] for tile_path in tile_paths])
+    catalog.insert(1, 'path_RGB', tile_paths)
+    for product, (directory, suffix) in products.items():
+        catalog['path_' + product]=[os.path.join(directory, name + suffix).replace('\\', '/') for name in catalog.NAME]
+
+    if chm_paths:
+        chm_footprints=np.array([get_raster_metadata(chm_path)[0]['geometry'] for chm_path in chm_paths])
+        overlaps=shapely.area(shapely.intersection(catalog.geometry.to_numpy()[:, np.newaxis], chm_footprints[np.newaxis, :]))
+        catalog['path_CHM']=np.where(overlaps.max(axis=1) > 0, np.array(chm_paths, dtype=object)[overlaps.argmax(axis=1)], None)
+
+    return catalog
+
+
+def read_tile_catalog(path, bbox=None):
+    '''
+    Read the catalog of the tiles. The spatial index of the GeoPackage is used to only read the tiles in the bounding box.
+
+    - path: path to the catalog
+    - bbox: bounds (minx, miny, maxx, maxy) of the zone of interest. If None, all the tiles are read.
+    return: a geodataframe with the footprint, metadata and paths of each tile.
+    '''
+
+    return gpd.read_file(path, bbox=tuple(bbox) if bbox is not None else None)
+
+
+def get_output_profile(profile, output_options=None, **kwargs):
+    '''
+    Get the profile of a raster to write with the output options shared by all the raster writers.
+
+    - profile: profile of the source raster
+    - output_options: dictionary with the output options of the config file (tiled, blocksize, compress, predictor).
+        If None, the source profile is only updated with kwargs.
+    - kwargs: additional updates of the profile, like the number of bands or the data type
+    return: the profile for the output raster.
+    '''
+
+    out_profile=profile.copy()
+    out_profile.update(**kwargs)
+
+    if not output_options:
+        return out_profile
+    
+    out_profile.update(driver='GTiff', BIGTIFF='IF_SAFER')
+
+    if output_options['tiled']:
+        out_profile.update(tiled=True, blockxsize=output_options['blocksize'], blockysize=output_options['blocksize'])
+
+    if output_options['compress']:
+        out_profile.update(compress=output_options['compress'])
+        if output_options['predictor']:
+            # Floating point predictor for float data, horizontal differencing otherwise
+            out_profile.update(predictor=3 if np.issubdtype(np.dtype(out_profile['dtype']), np.floating) else 2)
+
+    return out_profile
+
+
+def build_overviews(dst, output_options=None, resampling=Resampling.average):
+    '''
+    Build the internal overviews of a raster opened in writing mode, if requested in the output options.
+
+    - dst: rasterio dataset opened in writing mode
+    - output_options: dictionary with the output options of the config file (overviews)
+    - resampling: resampling method for the overviews
+    '''
+
+    if output_options and output_options['overviews']:
+        dst.build_overviews(output_options['overviews'], resampling)
+        dst.update_tags(ns='rio_overview', resampling=resampling.name)
+
+
+def get_raster(path, cache_size=16):
+    '''
+    Open a raster in read mode and keep it in a cache of the current process, so that each worker opens a file only once.
+    The least recently used raster is closed when the cache is full.
+
+    - path: path to the raster
+    - cache_size: maximum number of rasters kept open
+    return: the rasterio dataset.
+    '''
+
+    if path in OPEN_RASTERS:
+        OPEN_RASTERS.move_to_end(path)
+        return OPEN_RASTERS[path]
+
+    src=rasterio.open(path)
+    OPEN_RASTERS[path]=src
+
+    while len(OPEN_RASTERS) > cache_size:
+        _, old_src=OPEN_RASTERS.popitem(last=False)
+        old_src.close()
+
+    return src
+
+
+def get_window(bounds, src):
+    '''
+    Get the window of a raster covering some bounds, limited to the extent of the raster.
+
+    - bounds: bounds (minx, miny, maxx, maxy) of the zone of interest
+    - src: rasterio dataset
+    return: a rasterio window with integer offsets and lengths.
+    '''
+
+    window=from_bounds(*bounds, transform=src.transform)
+
+    col_start=max(int(np.floor(window.col_off)), 0)
+    row_start=max(int(np.floor(window.row_off)), 0)
+    col_stop=min(int(np.ceil(window.col_off + window.width)), src.width)
+    row_stop=min(int(np.ceil(window.row_off + window.height)), src.height)
+
+    return Window(col_start, row_start, max(col_stop-col_start, 0), max(row_stop-row_start, 0))
+
+
+def get_height_mask(chm_path, transform, shape, cache_size=16):
+    '''
+    Get the mask of the pixels of an image where the binary CHM is equal to 1. The CHM is resampled to the grid of the 
+    image with the nearest neighbour, i.e. the value of a pixel is the one of the CHM at its center.
+    Both rasters must be in the same CRS and north up.
+
+    - chm_path: path to the binary CHM
+    - transform: affine transform of the image
+    - shape: (height, width) of the image
+    - cache_size: maximum number of rasters kept open in the process
+    return: a boolean array with the shape of the image.
+    '''
+
+    chm=get_raster(chm_path, cache_size)
+    height_mask=np.zeros(shape, dtype=bool)
+
+    # Row and column in the CHM of the center of each row and column of the image
+    inverse_transform=~chm.transform
+    cols=np.floor(inverse_transform.a*(transform.c + transform.a*(np.arange(shape[1])+0.5)) + inverse_transform.c).astype(int)
+    rows=np.floor(inverse_transform.e*(transform.f + transform.e*(np.arange(shape[0])+0.5)) + inverse_transform.f).astype(int)
+    valid_cols=(cols>=0) & (cols<chm.width)
+    valid_rows=(rows>=0) & (rows<chm.height)
+    if not valid_cols.any() or not valid_rows.any():
+        return height_mask
+
+    cols=cols[valid_cols]
+    rows=rows[valid_rows]
+    col_off=cols.min()
+    row_off=rows.min()
+    chm_image=chm.read(1, window=Window(col_off, row_off, cols.max()-col_off+1, rows.max()-row_off+1))
+
+    height_mask[np.ix_(valid_rows, valid_cols)]=chm_image[np.ix_(rows-row_off, cols-col_off)]==1
+
+    return height_mask
+
+
+def get_masked_values(geom, src, bands, nodata=None, chm_path=None, cache_size=16):
+    '''
+    Read all the bands of the window under a geometry in one call and keep the values of the pixels whose center is
+    in the geometry.
+
+    - geom: shapely geometry determining the zone where the pixels are extracted
+    - src: rasterio dataset
+    - bands: bands to read
+    - nodata: value of no data. If None, the one of the raster is used.
+    - chm_path: path to a binary CHM. If given, only the pixels where the CHM is equal to 1 are kept (cf. get_height_mask).
+    - cache_size: maximum number of rasters kept open in the process
+    return: an array of shape (number of bands, number of pixels) with the valid values and nan elsewhere.
+    '''
+
+    bands=list(bands)
+    window=get_window(geom.bounds, src)
+    if window.width==0 or window.height==0:
+        return np.full((len(bands), 0), np.nan)
+    
+    image=src.read(bands, window=window).astype('float64')
+    geom_mask=geometry_mask([geom], out_shape=image.shape[1:], transform=src.window_transform(window), invert=True)
+    if chm_path:
+        geom_mask&=get_height_mask(chm_path, src.window_transform(window), image.shape[1:], cache_size)
+    values=image[:, geom_mask]
+
+    nodata=src.nodata if nodata is None else nodata
+    if nodata is not None:
+        values[values==nodata]=np.nan
+
+    # Scaled rasters, like the NDVI stored as int16
+    scales=np.array([src.scales[band-1] for band in bands])[:, np.newaxis]
+    offsets=np.array([src.offsets[band-1] for band in bands])[:, np.newaxis]
+    if (scales!=1).any() or (offsets!=0).any():
+        values=values*scales + offsets
+
+    return values
+
+
+def calculate_stats(values, stats=['min', 'max', 'mean', 'median', 'std']):
+    '''
+    Calculate the statistics of the valid values for all the bands in one vectorized pass.
+
+    - values: array of shape (number of bands, number of pixels) with nan for the invalid pixels
+    - stats: list of statistics to calculate among 'min', 'max', 'mean', 'median', 'std' and the percentiles
+        given as 'p<percentile>', e.g. 'p10'
+    return: an array of shape (number of bands, number of stats). The statistics are nan for bands without valid values.
+    '''
+
+    stats_functions={'min': np.nanmin, 'max': np.nanmax, 'mean': np.nanmean, 'median': np.nanmedian, 'std': np.nanstd}
+
+    if values.shape[1]==0:
+        return np.full((values.shape[0], len(stats)), np.nan)
+
+    with warnings.catch_warnings():
+        # bands without valid values return nan
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        stats_values=np.stack([stats_functions[stat](values, axis=1) if stat in stats_functions.keys()
+                               else np.nanpercentile(values, float(stat[1:]), axis=1) 
+                               for stat in stats], axis=1)
+
+    return stats_values
+
+
+def get_ndvi(red_band, nir_band):
+    '''
+    Calculate the NDVI from the red and nir values, with the NDVI set to 0 where the sum of the bands is 0.
+
+    - red_band: array of the red values
+    - nir_band: array of the nir values
+    return: array of the NDVI as float32.
+    '''
+
+    red_band=red_band.astype('float32')
+    nir_band=nir_band.astype('float32')
+    ndvi=np.divide((nir_band - red_band),(nir_band + red_band),
+                    out=np.zeros_like(nir_band - red_band),
+                    where=(nir_band + red_band)!=0)
+    
+    return ndvi
+
+
+def zonal_stats(zones, bands=range(1,5), stats=['min', 'max', 'mean', 'median', 'std'],
+                nodata_rgb=None, nodata_ndvi=None, cache_size=16, ndvi_bands=None, chm_path=None):
+    '''
+    Calculate the statistics of the pixels under each zone for the bands of the tiles and for their NDVI.
+    A zone can be made of several pieces on different tiles. The pixels of all the pieces are gathered before
+    calculating the statistics, so that they are exact for the whole zone.
+    Each raster is opened once per process (cf. get_raster) and all the bands of a piece window are read in one call.
+
+    - zones: list of zones, each given as a list of pieces (geometry, path to the multiband tile, path to the NDVI tile)
+    - bands: bands of the multiband tiles
+    - stats: list of statistics to calculate (cf. calculate_stats)
+    - nodata_rgb: value of no data for the multiband tiles. If None, the one of the raster is used.
+    - nodata_ndvi: value of no data for the NDVI tiles. If None, the one of the raster is used.
+    - cache_size: maximum number of rasters kept open in the process
+    - ndvi_bands: numbers of the red and nir bands used to derive the NDVI from the pixels of the multiband tiles. 
+        If None, the NDVI is read from the NDVI tiles.
+    - chm_path: path to a binary CHM. If given, only the pixels where the CHM is equal to 1 are considered.
+    return: an array of shape (number of zones, number of bands + 1, number of stats) with the NDVI as last band.
+    '''
+
+    bands=list(bands)
+    zones_stats=np.full((len(zones), len(bands)+1, len(stats)), np.nan)
+
+    for i, pieces in enumerate(zones):
+        values_rgb=[]
+        values_ndvi=[]
+        for geom, path_rgb, path_ndvi in pieces:
+            values_rgb.append(get_masked_values(geom, get_raster(path_rgb, cache_size), bands, nodata_rgb, chm_path, cache_size))
+            if ndvi_bands:
+                red_band, nir_band=values_rgb[-1][[bands.index(ndvi_bands[0]), bands.index(ndvi_bands[1])]]
+                # nan values of the invalid pixels are propagated to the NDVI
+                values_ndvi.append(get_ndvi(red_band, nir_band)[np.newaxis, :])
+            else:
+                values_ndvi.append(get_masked_values(geom, get_raster(path_ndvi, cache_size), [1], nodata_ndvi, chm_path, cache_size))
+
+        zones_stats[i, :-1, :]=calculate_stats(np.concatenate(values_rgb, axis=1), stats)
+        zones_stats[i, -1, :]=calculate_stats(np.concatenate(values_ndvi, axis=1), stats)
+
+    return zones_stats
@@ -4,16 +4,37 @@ import numpy as np
 import pandas as pd
 
 from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
 
+import matplotlib
+matplotlib.use('Agg')   # no display needed, the figures are only saved
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 import plotly.express as px
+from joblib import Parallel, delayed
 
 sys.path.insert(1, '03_Scripts')
 from functions.fct_misc import ensure_dir_exists
 
+def broken_stick_model(n):
+    '''
+    Get the Broken stick model (MacArthur, 1957) for n components.
+
+    - n: number of components
+
+    return: the list of values for the Broken stick model.
+    '''
+
+    bsm=[1/n]
+    for k in range(n-1):
+        bsm.append(bsm[k] + 1/(n-1-k))
+    bsm=[100*x/n for x in bsm]
+    bsm.reverse()
+
+    return bsm
+
+
 def evplot(ev):
     '''
     Implementation of Kaiser's rule and the Broken stick model (MacArthur, 1957) to determine the number of components to keep in the PCA.
@@ -28,11 +49,7 @@ def evplot(ev):
 
     # Broken stick model (MacArthur 1957)
     j=np.arange(n)+1
-    bsm=[1/n]
-    for k in range(n-1):
-        bsm.append(bsm[k] + 1/(n-1-k))
-    bsm=[100*x/n for x in bsm]
-    bsm.reverse()
+    bsm=broken_stick_model(n)
 
     avg_ev=sum(ev)/len(ev)
 
@@ -111,18 +128,53 @@ def calculate_pca(dataset, features, to_describe, label_pc):
     return pca, coor_PC
 
 
-def plot_pca(coor, results, model,
-            features, to_describe, targets, pc_to_plot=2,
+def calculate_incremental_pca(get_chunks, features):
+    '''
+    Calculate a PCA chunk by chunk, without loading the whole dataset in memory.
+
+    - get_chunks: function returning a new iterator over the chunks (dataframes) of the dataset
+    - features: decriptive variables of the dataset (must be numerical only)
+
+    return: a fitted sklearn StandardScaler and IncrementalPCA objects.
+    '''
+
+    # 1. Define the variables and scale
+    scaler = StandardScaler()
+    for chunk in get_chunks():
+        scaler.partial_fit(chunk.loc[:,features].values)
+
+    # 2. Calculate the PCA
+    # Each batch must have at least as many individuals as there are components,
+    # so the last batch is kept until the end to append the remaining individuals to it.
+    pca = IncrementalPCA(n_components = len(features))
+    previous_batch = None
+    batch = np.empty((0, len(features)))
+    for chunk in get_chunks():
+        batch = np.concatenate([batch, scaler.transform(chunk.loc[:,features].values)])
+        if batch.shape[0] >= len(features):
+            if previous_batch is not None:
+                pca.partial_fit(previous_batch)
+            previous_batch = batch
+            batch = np.empty((0, len(features)))
+
+    if previous_batch is None:
+        raise ValueError(f'The PCA needs at least {len(features)} individuals, only {batch.shape[0]} were given.')
+    pca.partial_fit(np.concatenate([previous_batch, batch]))
+
+    return scaler, pca
+
+
+def plot_pc_pair(pc, results, model,
+            features, to_describe, targets,
             dirpath_images='images', file_prefix='', title_graph=''):
     '''
-    Plot the individuals and the variables along those components. The results are saved as files.
+    Plot the individuals and the variables along the first and the pc-th components. The results are saved as files.
 
-    - coor: array with the new coordinates for the principal components
+    - pc: number of the component to plot against the first one
     - results: dataframe with the new coordinates in the space of the PC
     - pca: sklearn pca or lda object
     - features: decriptive variables of the dataset (must be numerical only)
     - targets: classes of interest in the response variable.
-    - pc_to_plot: number of principal components to plot
     - dirpath_images: directory for the images
     - file_prefix: prefix for the names of the files that will be created
     - title_graph: string with the title for the graphs (the same for all)
@@ -136,71 +188,149 @@ def plot_pca(coor, results, model,
 
     colors=[key[4:] for key in mcolors.TABLEAU_COLORS.keys()][:len(targets)]
 
-    for pc in range(2,pc_to_plot+1):
-        fig = plt.figure(figsize = (8,8))
-
-        ax = fig.add_subplot(1,1,1) 
-        ax.set_xlabel(f'Principal Component 1 ({expl_var_ratio[0]}%)', fontsize = 15)
-        ax.set_ylabel(f'Principal Component {pc} ({expl_var_ratio[1]}%)', fontsize = 15)
-        ax.set_title(title_graph, fontsize = 20)
-
-        for target, color in zip(targets, colors):
-            indicesToKeep = results[to_describe] == target
-            ax.scatter(results.loc[indicesToKeep, 'PC1']
-                    , results.loc[indicesToKeep, f'PC{pc}']
-                    , c = color
-                    , s = 50)
-        ax.legend(targets)
-        ax.set_aspect(1)
-        ax.grid()
-
-        figpath=os.path.join(dirpath_images, file_prefix + f'PC1{pc}_individuals.jpg')
-        fig.savefig(figpath, bbox_inches='tight')
-        written_files.append(figpath)
-
-        # 5. Plot the graph of the variables
-        labels_column=[f'Principal component {k+1} ({expl_var_ratio[k]}%)' for k in range(len(features))]
-        coor=pd.DataFrame(coor, columns=labels_column)
-
-        # fig = px.scatter(coor, x= f'Principal component 1 ({expl_var_ratio[0]}%)', y=f'Principal component {pc} ({expl_var_ratio[1]}%)', color=results_PCA['road_type'])
-        fig = px.scatter(pd.DataFrame(columns=labels_column),
-                        x = f'Principal component 1 ({expl_var_ratio[0]}%)', y=f'Principal component {pc} ({expl_var_ratio[1]}%)',
-                        title = title_graph)
-
-        for i, feature in enumerate(features):
-            fig.add_shape(
-                type='line',
-                x0=0, y0=0,
-                x1=loadings[i, 0],
-                y1=loadings[i, 1]
-            )
-
-            fig.add_annotation(
-                x=loadings[i, 0],
-                y=loadings[i, 1],
-                ax=0, ay=0,
-                xanchor="center",
-                yanchor="bottom",
-                text=feature,
-            )
-
-        fig.update_yaxes(
-        scaleanchor = "x",
-        scaleratio = 1,
+    fig = plt.figure(figsize = (8,8))
+
+    ax = fig.add_subplot(1,1,1) 
+    ax.set_xlabel(f'Principal Component 1 ({expl_var_ratio[0]}%)', fontsize = 15)
+    ax.set_ylabel(f'Principal Component {pc} ({expl_var_ratio[pc-1]}%)', fontsize = 15)
+    ax.set_title(title_graph, fontsize = 20)
+
+    for target, color in zip(targets, colors):
+        indicesToKeep = results[to_describe] == target
+        ax.scatter(results.loc[indicesToKeep, 'PC1']
+                , results.loc[indicesToKeep, f'PC{pc}']
+                , c = color
+                , s = 50)
+    ax.legend(targets)
+    ax.set_aspect(1)
+    ax.grid()
+
+    figpath=os.path.join(dirpath_images, file_prefix + f'PC1{pc}_individuals.jpg')
+    fig.savefig(figpath, bbox_inches='tight')
+    plt.close(fig)
+    written_files.append(figpath)
+
+    # 5. Plot the graph of the variables
+    labels_column=[f'Principal component {k+1} ({expl_var_ratio[k]}%)' for k in range(len(features))]
+
+    # fig = px.scatter(coor, x= f'Principal component 1 ({expl_var_ratio[0]}%)', y=f'Principal component {pc} ({expl_var_ratio[1]}%)', color=results_PCA['road_type'])
+    fig = px.scatter(pd.DataFrame(columns=labels_column),
+                    x = f'Principal component 1 ({expl_var_ratio[0]}%)', y=f'Principal component {pc} ({expl_var_ratio[pc-1]}%)',
+                    title = title_graph)
+
+    for i, feature in enumerate(features):
+        fig.add_shape(
+            type='line',
+            x0=0, y0=0,
+            x1=loadings[i, 0],
+            y1=loadings[i, pc-1]
         )
 
-        fig.update_layout(
-            margin=dict(l=20, r=10, t=40, b=10),
+        fig.add_annotation(
+            x=loadings[i, 0],
+            y=loadings[i, pc-1],
+            ax=0, ay=0,
+            xanchor="center",
+            yanchor="bottom",
+            text=feature,
         )
 
-        file_graph_feat = os.path.join(dirpath_images, file_prefix + f'PC1{pc}_features.jpeg')
-        fig.write_image(file_graph_feat)
-        
-        file_graph_feat_webp = file_graph_feat.replace('jpeg','webp')
-        fig.write_image(file_graph_feat_webp)
+    fig.update_yaxes(
+    scaleanchor = "x",
+    scaleratio = 1,
+    )
+
+    fig.update_layout(
+        margin=dict(l=20, r=10, t=40, b=10),
+    )
+
+    file_graph_feat = os.path.join(dirpath_images, file_prefix + f'PC1{pc}_features.jpeg')
+    fig.write_image(file_graph_feat)
+    
+    file_graph_feat_webp = file_graph_feat.replace('jpeg','webp')
+    fig.write_image(file_graph_feat_webp)
+
+    written_files.append(file_graph_feat)
+    written_files.append(file_graph_feat_webp)
+
+    return written_files
+
+
+def plot_pca(coor, results, model,
+            features, to_describe, targets, pc_to_plot=2,
+            dirpath_images='images', file_prefix='', title_graph=''):
+    '''
+    Plot the individuals and the variables along those components (function plot_pc_pair). The results are saved as files.
+
+    - coor: array with the new coordinates for the principal components
+    - results: dataframe with the new coordinates in the space of the PC
+    - pca: sklearn pca or lda object
+    - features: decriptive variables of the dataset (must be numerical only)
+    - targets: classes of interest in the response variable.
+    - pc_to_plot: number of principal components to plot
+    - dirpath_images: directory for the images
+    - file_prefix: prefix for the names of the files that will be created
+    - title_graph: string with the title for the graphs (the same for all)
+    return: a list of the written files.
+    '''
+
+    written_files=[]
 
-        written_files.append(file_graph_feat)
-        written_files.append(file_graph_feat_webp)
+    for pc in range(2,pc_to_plot+1):
+        written_files.extend(plot_pc_pair(pc, results, model, features, to_describe, targets,
+                                        dirpath_images, file_prefix, title_graph))
+
+    return written_files
+
+
+def plot_pc_number(ev, figpath):
+    '''
+    Plot the eigenvalues with the Kaiser's rule and the Broken stick model (function evplot) and save the figure.
+
+    - ev: eigenvalues of the PCA
+    - figpath: path of the figure
+    return: a list of the written files.
+    '''
+
+    _, fig = evplot(ev)
+    fig.savefig(figpath, bbox_inches='tight')
+    plt.close(fig)
+
+    return [figpath]
+
+
+def plot_boxplots(dataset, by, filepath, **kwargs):
+    '''
+    Make a boxplot of each column of the dataset grouped by class and save the figure.
+
+    - dataset: dataframe with the values to plot
+    - by: column with the classes
+    - filepath: path of the figure
+    - kwargs: other parameters passed to pandas.DataFrame.plot.box
+    return: a list of the written files.
+    '''
+
+    boxplots=dataset.plot.box(by=by, **kwargs)
+    fig=np.ravel(boxplots)[0].get_figure()
+    fig.savefig(filepath, bbox_inches='tight')
+    plt.close(fig)
+
+    return [filepath]
+
+
+def render_queued_figures(figures, n_jobs=1):
+    '''
+    Render the queued figures in a pool of processes.
+    The processes are reused from one figure to the next, so that the kaleido process used by plotly is only started once per process.
+
+    - figures: list of figures to render as tuples (plotting function, args, kwargs), the function returning the list of written files
+    - n_jobs: number of processes
+    return: a list of the written files.
+    '''
+
+    written_files=[]
+    for figure_files in Parallel(n_jobs=n_jobs, return_as='generator')(delayed(function)(*args, **kwargs) for function, args, kwargs in figures):
+        written_files.extend(figure_files)
 
     return written_files
 
@@ -208,20 +338,25 @@ def plot_pca(coor, results, model,
 def pca_procedure(dataset, features, to_describe,
                 dirpath_tables='tables',  dirpath_images='images',
                 file_prefix='PCA_',
-                title_graph = 'PCA'):
+                title_graph = 'PCA',
+                render_figures=True, figure_queue=None):
     '''
     Calculate a PCA (function calculate_PCA), determine the number of components to keep (function evplot and 
     determine_pc_num), save the loadings and correlations, plot the individuals and the variables along those
     components (function plot_pca).
     The results are saved as files.
 
-    - dataset: dataset from which the PCA will be calculated
+    - dataset: dataset from which the PCA will be calculated, either a dataframe or a function returning a new iterator over
+        the chunks (dataframes) of the dataset. With chunks, the PCA is calculated incrementally (function calculate_incremental_pca).
     - features: decriptive variables of the dataset (must be numerical only)
     - to_describe: response variables or the variables to describe with the PCA (FOR NOW, ONLY ONE RESPONSE VARIALBE CAN BE PASSED)
     - dirpath_tables: direcory for the tables
     - dirpath_images: directory for the images
     - file_prefix: prefix for the names of the files that will be created
     - title_graph: string with the title for the graphs (the same for all)
+    - render_figures: if False, only the tables are produced
+    - figure_queue: list to which the figures are appended to be rendered later with the function render_queued_figures,
+        if None, the figures are rendered immediately
     return: a list of the written files.
     '''
 
@@ -232,28 +367,49 @@ def pca_procedure(dataset, features, to_describe,
 
     file_prefix = file_prefix + '_' if file_prefix[-1]!='_' else file_prefix
 
-    # 1 & 2. Define the variables, scale & calculate the PCA
-    pca, coor_PC=calculate_pca(dataset, features, to_describe, label_pc)
+    filepath=os.path.join(dirpath_tables, file_prefix + 'values.csv')
 
-    coor_PC_df = pd.DataFrame(data = coor_PC, columns = label_pc)
-    try:
-        results_PCA = pd.concat([coor_PC_df, dataset[[to_describe, 'id']]], axis = 1)
-    except KeyError:
-        results_PCA = pd.concat([coor_PC_df, dataset[to_describe]], axis = 1)
+    if isinstance(dataset, pd.DataFrame):
+        # 1 & 2. Define the variables, scale & calculate the PCA
+        pca, coor_PC=calculate_pca(dataset, features, to_describe, label_pc)
+
+        coor_PC_df = pd.DataFrame(data = coor_PC, columns = label_pc)
+        try:
+            results_PCA = pd.concat([coor_PC_df, dataset[[to_describe, 'id']]], axis = 1)
+        except KeyError:
+            results_PCA = pd.concat([coor_PC_df, dataset[to_describe]], axis = 1)
+
+        results_PCA.round(3).to_csv(filepath, index=False)
+
+        targets = dataset[to_describe].unique().tolist()
+
+    else:
+        # 1 & 2. Define the variables, scale & calculate the PCA chunk by chunk
+        scaler, pca = calculate_incremental_pca(dataset, features)
+
+        # Project the individuals chunk by chunk and append them to the table
+        targets = []
+        for i, chunk in enumerate(dataset()):
+            chunk.reset_index(drop=True, inplace=True)
+            coor_PC_df = pd.DataFrame(data = pca.transform(scaler.transform(chunk.loc[:,features].values)), columns = label_pc)
+            try:
+                results_PCA = pd.concat([coor_PC_df, chunk[[to_describe, 'id']]], axis = 1)
+            except KeyError:
+                results_PCA = pd.concat([coor_PC_df, chunk[to_describe]], axis = 1)
+
+            results_PCA.round(3).to_csv(filepath, index=False, mode='w' if i==0 else 'a', header=i==0)
+
+            targets.extend(target for target in chunk[to_describe].unique().tolist() if target not in targets)
 
-    filepath=os.path.join(dirpath_tables, file_prefix + 'values.csv')
-    results_PCA.round(3).to_csv(filepath, index=False)
     written_files.append(filepath)
 
     # 3. Get the number of components to plot and keep
     eigenvalues=pca.explained_variance_
-    bsm, fig_pc_num = evplot(eigenvalues)
+    bsm = broken_stick_model(len(eigenvalues))
 
     pc_to_plot = determine_pc_num(eigenvalues, bsm)
 
-    figpath=os.path.join(dirpath_images, file_prefix + 'PC_to_keep_evplot.jpg')
-    fig_pc_num.savefig(figpath, bbox_inches='tight')
-    written_files.append(figpath)
+    figures=[(plot_pc_number, (eigenvalues, os.path.join(dirpath_images, file_prefix + 'PC_to_keep_evplot.jpg')), {})]
 
     # 3 bis. Get features correlation and covariance
     # cf. https://scentellegher.github.io/machine-learning/2020/01/27/pca-loadings-sklearn.html
@@ -270,10 +426,13 @@ def pca_procedure(dataset, features, to_describe,
     written_files.append(filepath)
 
     # 4 & 5. Plot the graph of the individuals and of the variables
-    targets = dataset[to_describe].unique().tolist()
-    
-   # written_files.extend(plot_pca(coor_PC, results_PCA, pca, features, to_describe, targets, pc_to_plot,
-    #                            dirpath_images, file_prefix, title_graph))
+   # figures.extend((plot_pc_pair, (pc, results_PCA, pca, features, to_describe, targets,
+    #                            dirpath_images, file_prefix, title_graph), {}) for pc in range(2, pc_to_plot+1))
+
+    if render_figures and figure_queue is None:
+        written_files.extend(render_queued_figures(figures))
+    elif render_figures:
+        figure_queue.extend(figures)
 
     return written_files
 
@@ -307,7 +466,8 @@ def calculate_lda(dataset, features, to_describe):
 def lda_procedure(dataset, features, to_describe,
                 dirpath_tables='tables',  dirpath_images='images',
                 file_prefix='LDA_',
-                title_graph = 'LDA'):
+                title_graph = 'LDA',
+                render_figures=True, figure_queue=None):
     '''
     Calculate a LDA (function calculate_LDA), determine the number of components to keep (function evplot and 
     determine_pc_num), save the loadings and correlations, plot the individuals and the variables along those
@@ -321,6 +481,9 @@ def lda_procedure(dataset, features, to_describe,
     - dirpath_images: directory for the images
     - file_prefix: prefix for the names of the files that will be created
     - title_graph: string with the title for the graphs (the same for all)
+    - render_figures: if False, only the tables are produced
+    - figure_queue: list to which the figures are appended to be rendered later with the function render_queued_figures,
+        if None, the figures are rendered immediately
     return: a list of the written files.
     '''
 
@@ -345,13 +508,11 @@ def lda_procedure(dataset, features, to_describe,
 
     # 3. Get the number of components to plot and keep
     eigenvalues=lda.explained_variance_
-    bsm, fig_pc_num = evplot(eigenvalues)
+    bsm = broken_stick_model(len(eigenvalues))
 
     pc_to_plot = determine_pc_num(eigenvalues, bsm)
 
-    figpath=os.path.join(dirpath_images, file_prefix + 'PC_to_keep_evplot.jpg')
-    fig_pc_num.savefig(figpath, bbox_inches='tight')
-    written_files.append(figpath)
+    figures=[(plot_pc_number, (eigenvalues, os.path.join(dirpath_images, file_prefix + 'PC_to_keep_evplot.jpg')), {})]
 
     # # 3 bis. Get features correlation and covariance
     # # cf. https://scentellegher.github.io/machine-learning/2020/01/27/pca-loadings-sklearn.html
@@ -370,7 +531,12 @@ def lda_procedure(dataset, features, to_describe,
     # 4 & 5. Plot the graph of the individuals and of the variables
     targets = dataset[to_describe].unique().tolist()
     
-    written_files.extend(plot_pca(coor, results_PCA, lda, features, to_describe, targets, pc_to_plot,
-                                dirpath_images, file_prefix, title_graph))
+    figures.extend((plot_pc_pair, (pc, results_PCA, lda, features, to_describe, targets,
+                                dirpath_images, file_prefix, title_graph), {}) for pc in range(2, pc_to_plot+1))
+
+    if render_figures and figure_queue is None:
+        written_files.extend(render_queued_figures(figures))
+    elif render_figures:
+        figure_queue.extend(figures)
 
     return written_files
\ No newline at end of file
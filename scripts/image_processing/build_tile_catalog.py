@@ -0,0 +1,46 @@
+import os, sys
+import yaml
+import time
+
+from loguru import logger
+from glob import glob
+
+sys.path.insert(1, os.path.abspath('scripts'))
+import functions.fct_misc as fct_misc
+
+
+if __name__ == "__main__":
+
+    logger=fct_misc.format_logger(logger)
+
+    tic = time.time()
+    logger.info('Starting...')
+
+    logger.info(f"Using config.yaml as config file.")
+    with open('config/config_ImPro.yaml') as fp:
+            cfg = yaml.load(fp, Loader=yaml.FullLoader)['build_tile_catalog.py']
+
+    logger.info('Defining constants...')
+
+    WORKING_DIR=cfg['working_directory']
+
+    INPUTS=cfg['inputs']
+    ORTHO=INPUTS['ortho_directory']
+    CHM=INPUTS['chm']
+
+    PRODUCTS=cfg['products']
+    TILE_CATALOG=cfg['tile_catalog']
+    N_JOBS=cfg['n_jobs'] if cfg['n_jobs'] else os.cpu_count()
+
+    os.chdir(WORKING_DIR)
+
+    _=fct_misc.ensure_dir_exists(os.path.dirname(TILE_CATALOG))
+
+    logger.info(f'Reading the headers of the tiles with {N_JOBS} processes...')
+    tile_list=sorted(glob(os.path.join(ORTHO, '*.tif')))
+    catalog=fct_misc.build_tile_catalog(tile_list, PRODUCTS, CHM, n_jobs=N_JOBS)
+
+    # The GeoPackage is written with a spatial index, used to find the tiles under the trees.
+    catalog.to_file(TILE_CATALOG, layer='tiles', driver='GPKG')
+
+    logger.success(f'The catalog of {catalog.shape[0]} tiles was written in {TILE_CATALOG}.')
@@ -1,20 +1,55 @@
 import os, sys
 import yaml
 import time
+import hashlib
 
-import geopandas as gpd
 import numpy as np
 import rasterio
 
 from loguru import logger
 from tqdm import tqdm
-from glob import glob
+from joblib import Parallel, delayed
 
-sys.path.insert(1, 'scripts')
+# absolute path for the worker processes, which start after the change of working directory
+sys.path.insert(1, os.path.abspath('scripts'))
 import functions.fct_misc as fct_misc
 
+# The NDVI stored as int16 is multiplied by 10'000
+NDVI_INT16_SCALE=1e-4
+NDVI_INT16_NODATA=-32768
 
-def calculate_ndvi(tile, band_nbr_red=0, band_nbr_nir=3, path=None):
+
+def get_ndvi_profile(profile, output_options=None):
+    '''
+    Get the profile of the NDVI raster based on the one of the tile and on the output options.
+
+    - profile: profile of the tile
+    - output_options: dictionary with the output options of the config file. If None, the NDVI is saved as float32.
+    return: the profile for the NDVI raster.
+    '''
+
+    if output_options and output_options['ndvi_int16']:
+        return fct_misc.get_output_profile(profile, output_options, count=1, dtype='int16', nodata=NDVI_INT16_NODATA)
+    
+    return fct_misc.get_output_profile(profile, output_options, count=1, dtype='float32')
+
+
+def write_ndvi(dst, ndvi, window=None):
+    '''
+    Write the NDVI to a raster, scaled to integers if the raster is of type int16.
+
+    - dst: rasterio dataset opened in writing mode
+    - ndvi: array of the NDVI values
+    - window: window where to write the values. If None, the whole raster is written.
+    '''
+
+    if dst.dtypes[0]=='int16':
+        dst.write(np.round(ndvi/NDVI_INT16_SCALE).astype('int16'), 1, window=window)
+    else:
+        dst.write(ndvi, 1, window=window)
+
+
+def calculate_ndvi(tile, band_nbr_red=0, band_nbr_nir=3, path=None, windowed=False, output_options=None):
     '''
     Calculate the NDVI for each pixel of a tile and save the result in a new folder.
 
@@ -22,9 +57,16 @@ def calculate_ndvi(tile, band_nbr_red=0, band_nbr_nir=3, path=None):
     - band_nbr_red: number of the red band in the image
     - band_nbr_nir: number of the nir band in the image
     - path: filepath were to save the result. If None, no file is saved
-    return: array with the ndvi value for each pixel.
+    - windowed: boolean indicating if the NDVI should be calculated and written block by block, so that the memory
+        use is bounded by the block size. Only possible if a path is given.
+    - output_options: dictionary with the output options of the config file. If None, the profile of the tile is used.
+    return: array with the ndvi value for each pixel or None in windowed mode.
     '''
 
+    if windowed and path:
+        calculate_ndvi_by_block(tile, band_nbr_red, band_nbr_nir, path, output_options)
+        return None
+
     with rasterio.open(tile) as src:
         image = src.read()
         im_profile=src.profile
@@ -36,13 +78,135 @@ def calculate_ndvi(tile, band_nbr_red=0, band_nbr_nir=3, path=None):
                         where=(nir_band + red_band)!=0)
 
     if path:
-        im_profile.update(count= 1, dtype='float32')
-        with rasterio.open(path, 'w', **im_profile) as dst:
-            dst.write(ndvi_tile,1)
+        with rasterio.open(path, 'w', **get_ndvi_profile(im_profile, output_options)) as dst:
+            write_ndvi(dst, ndvi_tile)
+            if dst.dtypes[0]=='int16':
+                dst.scales=(NDVI_INT16_SCALE,)
+            fct_misc.build_overviews(dst, output_options)
 
     return ndvi_tile
 
 
+def calculate_ndvi_by_block(tile, band_nbr_red, band_nbr_nir, path, output_options=None):
+    '''
+    Calculate the NDVI for each internal block of the output raster and write it directly to the file.
+    Only the red and nir bands are read and the NDVI is computed in place into buffers reused for all the blocks.
+
+    - tile: path to the tile
+    - band_nbr_red: number of the red band in the image
+    - band_nbr_nir: number of the nir band in the image
+    - path: filepath were to save the result
+    - output_options: dictionary with the output options of the config file. If None, the profile of the tile is used.
+    '''
+
+    with rasterio.open(tile) as src, rasterio.open(path, 'w', **get_ndvi_profile(src.profile, output_options)) as dst:
+        block_windows=[window for _, window in dst.block_windows(1)]
+        max_height=max(window.height for window in block_windows)
+        max_width=max(window.width for window in block_windows)
+        ndvi_buffer=np.empty((max_height, max_width), dtype='float32')
+        sum_buffer=np.empty((max_height, max_width), dtype='float32')
+
+        for window in block_windows:
+            red_band, nir_band=src.read([band_nbr_red+1, band_nbr_nir+1], window=window)
+
+            ndvi_block=ndvi_buffer[:window.height, :window.width]
+            sum_block=sum_buffer[:window.height, :window.width]
+            np.subtract(nir_band, red_band, out=ndvi_block, dtype='float32')
+            np.add(nir_band, red_band, out=sum_block, dtype='float32')
+            np.divide(ndvi_block, sum_block, out=ndvi_block, where=sum_block!=0)
+            ndvi_block[sum_block==0]=0
+
+            write_ndvi(dst, ndvi_block, window=window)
+
+        if dst.dtypes[0]=='int16':
+            dst.scales=(NDVI_INT16_SCALE,)
+        fct_misc.build_overviews(dst, output_options)
+
+
+def get_file_hash(filepath, chunk_size=2**20):
+    '''
+    Calculate the SHA-256 hash of a file by chunks.
+
+    - filepath: path to the file
+    - chunk_size: number of bytes read at once
+    return: the hexadecimal digest of the file.
+    '''
+
+    file_hash=hashlib.sha256()
+    with open(filepath, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+def is_up_to_date(tile, ndvi_path, tile_hash=None):
+    '''
+    Test if the NDVI file of a tile exists and is up to date.
+
+    - tile: path to the tile
+    - ndvi_path: path to the NDVI file
+    - tile_hash: hash of the tile to compare with the one saved when the NDVI was calculated. If None, the modification
+        times are compared instead.
+    return: True if the NDVI file does not need to be calculated again.
+    '''
+
+    if not os.path.exists(ndvi_path):
+        return False
+    
+    if tile_hash:
+        hash_path=ndvi_path + '.sha256'
+        if not os.path.exists(hash_path):
+            return False
+        with open(hash_path) as fp:
+            return fp.read().strip()==tile_hash
+
+    return os.path.getmtime(ndvi_path) > os.path.getmtime(tile)
+
+
+def process_tile(tile, ndvi_path, windowed=False, use_hash=False, output_options=None):
+    '''
+    Calculate the NDVI of a tile if it is not up to date. The result and the hash of the tile are first written to
+    temporary files which are renamed once complete, so that an interrupted run never leaves a truncated raster nor
+    a hash that does not match it.
+
+    - tile: path to the tile
+    - ndvi_path: path to the NDVI file
+    - windowed: boolean indicating if the NDVI should be calculated block by block
+    - use_hash: boolean indicating if the hash of the tile should be used to determine if the NDVI is up to date
+    - output_options: dictionary with the output options of the config file
+    return: True if the NDVI was calculated, False if it was skipped.
+    '''
+
+    tile_hash=get_file_hash(tile) if use_hash else None
+    if is_up_to_date(tile, ndvi_path, tile_hash):
+        return False
+
+    root, ext=os.path.splitext(ndvi_path)
+    temp_path=root + '.tmp' + ext
+    hash_path=ndvi_path + '.sha256'
+    temp_hash_path=hash_path + '.tmp'
+
+    # A hash left from a former run must not validate the new raster if the run is interrupted.
+    if os.path.exists(hash_path):
+        os.remove(hash_path)
+
+    try:
+        _ = calculate_ndvi(tile, path=temp_path, windowed=windowed, output_options=output_options)
+        os.replace(temp_path, ndvi_path)
+
+        if use_hash:
+            with open(temp_hash_path, 'w') as fp:
+                fp.write(tile_hash)
+            os.replace(temp_hash_path, hash_path)
+    finally:
+        for path in (temp_path, temp_hash_path):
+            if path not in (ndvi_path, hash_path) and os.path.exists(path):
+                os.remove(path)
+
+    return True
+
+
 if __name__ == "__main__":
 
     logger=fct_misc.format_logger(logger)
@@ -59,26 +223,30 @@ if __name__ == "__main__":
     WORKING_DIR=cfg['working_directory']
 
     INPUTS=cfg['inputs']
-    ORTHO=INPUTS['ortho_directory']
-    NDVI=cfg['ndvi_output_directory']
-
-    TILE_DELIMITATION=INPUTS['tile_delimitation']
+    TILE_CATALOG=INPUTS['tile_catalog']
+    RGB_PRODUCT=INPUTS['rgb_product']
+    NDVI_PRODUCT=INPUTS['ndvi_product']
+    WINDOWED=cfg['windowed']
+    N_JOBS=cfg['n_jobs'] if cfg['n_jobs'] else os.cpu_count()
+    USE_HASH=cfg['use_hash']
+    OUTPUT_OPTIONS=cfg['output_profile']
 
     os.chdir(WORKING_DIR)
 
-    _=fct_misc.ensure_dir_exists(NDVI)
-
     logger.info('Reading files...')
     
-    tile_list_ortho=glob(os.path.join(ORTHO, '*.tif'))
-    aoi_tiles=gpd.read_file(TILE_DELIMITATION)
+    tiles=fct_misc.read_tile_catalog(TILE_CATALOG)
+    tile_list=tiles['path_' + RGB_PRODUCT].tolist()
+    ndvi_path_list=tiles['path_' + NDVI_PRODUCT].tolist()
 
-    tile_list=[]
-    tile_list.extend(tile_list_ortho)
+    ndvi_directories=sorted({os.path.dirname(ndvi_path) for ndvi_path in ndvi_path_list})
+    for directory in ndvi_directories:
+        _=fct_misc.ensure_dir_exists(directory)
 
-    for tile in tqdm(tile_list, 'Processing tiles'):
-        tile = tile.replace("\\","/") #handle windows path
-        ndvi_tile_path=os.path.join(NDVI, tile.split('/')[-1].replace('.tif', '_NDVI.tif'))
-        _ = calculate_ndvi(tile, path=ndvi_tile_path)
+    processed_tiles = Parallel(n_jobs=N_JOBS, return_as='generator')(
+        delayed(process_tile)(tile, ndvi_tile_path, WINDOWED, USE_HASH, OUTPUT_OPTIONS) for tile, ndvi_tile_path in zip(tile_list, ndvi_path_list)
+    )
+    nbr_processed_tiles=sum(tqdm(processed_tiles, 'Processing tiles', total=len(tile_list)))
 
-    logger.success(f'The files were written in the folder {NDVI}.')
\ No newline at end of file
+    logger.info(f'{nbr_processed_tiles} tiles were processed, {len(tile_list)-nbr_processed_tiles} were already up to date.')
+    logger.success(f'The files were written in the folder {", ".join(ndvi_directories)}.')
\ No newline at end of file
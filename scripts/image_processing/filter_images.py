@@ -5,173 +5,300 @@ from loguru import logger
 from tqdm import tqdm
 
 import numpy as np
-import geopandas as gpd
 import rasterio
 from osgeo import gdal
 from rasterio.enums import Resampling
+from rasterio.windows import Window
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
 
 import scipy
-from scipy.ndimage import binary_dilation
+from scipy.ndimage import distance_transform_cdt
+from joblib import Parallel, delayed
 
-sys.path.insert(1, 'scripts')
+sys.path.insert(1, os.path.abspath('scripts'))
 import functions.fct_misc as fct_misc
 
-logger=fct_misc.format_logger(logger)
-tic = time.time()
-logger.info('Starting...')
 
-logger.info(f"Using config.yaml as config file.")
-with open('config/config_ImPro.yaml') as fp:
-        cfg = yaml.load(fp, Loader=yaml.FullLoader)['filter_images.py']
+def gaussian_filter_tile(path_in, path_out, bands, sigma=5, window_size=None):
+    '''
+    Smooth all the bands of a tile at once with a Gaussian filter applied only on the spatial axes and save the result.
+    The tile can be processed by windows overlapping by the radius of the kernel, so that the memory use is bounded
+    while the result stays the same as for the whole tile.
+
+    - path_in: path to the tile
+    - path_out: filepath were to save the result
+    - bands: bands to filter
+    - sigma: standard deviation of the Gaussian kernel in pixels
+    - window_size: size of the windows in pixels. If None, the whole tile is processed at once.
+    '''
+
+    # Same truncation as the default one of scipy.ndimage.gaussian_filter
+    radius=int(4.0*sigma + 0.5)
+    bands=list(bands)
+
+    with rasterio.open(path_in) as src:
+        im_profile=fct_misc.get_output_profile(src.profile, OUTPUT_OPTIONS, count=len(bands))
+        dtype=np.dtype(im_profile['dtype'])
+        window_size=window_size if window_size else max(src.height, src.width)
+
+        with rasterio.open(path_out, 'w', **im_profile) as dst:
+            for row_off in range(0, src.height, window_size):
+                for col_off in range(0, src.width, window_size):
+                    height=min(window_size, src.height - row_off)
+                    width=min(window_size, src.width - col_off)
+
+                    halo_row_off=max(row_off - radius, 0)
+                    halo_col_off=max(col_off - radius, 0)
+                    halo_window=Window(halo_col_off, halo_row_off,
+                                       min(col_off + width + radius, src.width) - halo_col_off,
+                                       min(row_off + height + radius, src.height) - halo_row_off)
+
+                    im=src.read(bands, window=halo_window, out_dtype='float32')
+                    filtered_image=np.empty_like(im)
+                    scipy.ndimage.gaussian_filter(im, sigma=(0, sigma, sigma), output=filtered_image)
+
+                    filtered_image=filtered_image[:, row_off - halo_row_off:row_off - halo_row_off + height,
+                                                  col_off - halo_col_off:col_off - halo_col_off + width]
+                    if np.issubdtype(dtype, np.integer):
+                        np.rint(filtered_image, out=filtered_image)
+                        np.clip(filtered_image, np.iinfo(dtype).min, np.iinfo(dtype).max, out=filtered_image)
+
+                    dst.write(filtered_image.astype(dtype), window=Window(col_off, row_off, width, height))
+
+            fct_misc.build_overviews(dst, OUTPUT_OPTIONS)
+
+
+def write_resampled(src, dst, factor_x, factor_y, window_size=None, resampling=Resampling.bilinear):
+    '''
+    Resample an open tile into an open output by windows of the output: only the matching source window is read and
+    GDAL takes the pixels around it needed by the resampling kernel.
+
+    - src: rasterio dataset of the tile
+    - dst: rasterio dataset of the output, opened in write mode
+    - factor_x, factor_y: factors between the output and the input pixel sizes
+    - window_size: size of the output windows in pixels. If None, the whole output is processed at once.
+    - resampling: resampling method
+    '''
+
+    window_size=window_size if window_size else max(dst.height, dst.width)
+
+    for row_off in range(0, dst.height, window_size):
+        for col_off in range(0, dst.width, window_size):
+            height=min(window_size, dst.height - row_off)
+            width=min(window_size, dst.width - col_off)
+            src_window=Window(col_off*factor_x, row_off*factor_y, width*factor_x, height*factor_y)
+
+            filtered_image=src.read(out_shape=(src.count, height, width), window=src_window, resampling=resampling)
+            dst.write(filtered_image, window=Window(col_off, row_off, width, height))
+
+
+def downsample_tile(path_in, path_out, scale, window_size=None, resampling=Resampling.bilinear, use_overviews=False):
+    '''
+    Resample a tile to a lower resolution and save the result. The output is processed by windows: only the matching
+    source window is read and GDAL takes the pixels around it needed by the resampling kernel.
+
+    - path_in: path to the tile
+    - path_out: filepath were to save the result
+    - scale: factor between the output and the input resolution
+    - window_size: size of the output windows in pixels. If None, the whole tile is processed at once.
+    - resampling: resampling method
+    - use_overviews: boolean indicating if the internal overviews of the tile can be used when they exist
+    '''
+
+    open_options={} if use_overviews else {'OVERVIEW_LEVEL': 'NONE'}
+    with rasterio.open(path_in, **open_options) as src:
+        out_height=int(src.height * scale)
+        out_width=int(src.width * scale)
+        factor_y=src.height / out_height
+        factor_x=src.width / out_width
+
+        # scale image transform
+        transform = src.transform * src.transform.scale(factor_x, factor_y)
+        im_profile=fct_misc.get_output_profile(src.profile, OUTPUT_OPTIONS, height=out_height, width=out_width, transform=transform)
+
+        with rasterio.open(path_out, 'w', **im_profile) as dst:
+            write_resampled(src, dst, factor_x, factor_y, window_size, resampling)
+            fct_misc.build_overviews(dst, OUTPUT_OPTIONS)
+
+
+def pyramid_tile(path_in, filename, levels, window_size=None, resampling=Resampling.bilinear):
+    '''
+    Read a tile once and resample it to several resolutions. The tile is decoded block by block into an uncompressed
+    in-memory copy, from which each level is resampled (cf. write_resampled), so that the compressed tile is not decoded
+    again for each level. The outputs have the same origin as the tile and a pixel size equal to the requested
+    resolution. The tile is supposed to be north-up.
+
+    - path_in: path to the tile
+    - filename: name of the output files
+    - levels: dictionary with the resolutions in the units of the CRS as keys and the output directories as values
+    - window_size: size of the output windows in pixels. If None, each level is processed at once.
+    - resampling: resampling method
+    '''
+
+    with rasterio.open(path_in) as src:
+        src_profile=src.profile
+        # no compression, so that the copy is exact and cheap to read
+        mem_profile={'driver': 'GTiff', 'count': src.count, 'dtype': src.dtypes[0], 'width': src.width, 'height': src.height,
+                     'crs': src.crs, 'transform': src.transform, 'nodata': src.nodata,
+                     'tiled': True, 'blockxsize': 256, 'blockysize': 256}
+
+        memfile=MemoryFile()
+        with memfile.open(**mem_profile) as mem:
+            for _, window in src.block_windows(1):
+                mem.write(src.read(window=window), window=window)
+
+    with memfile, memfile.open() as mem:
+        for resolution, directory in levels.items():
+            factor_x=resolution/mem.res[0]
+            factor_y=resolution/mem.res[1]
+            out_width=int(mem.width/factor_x)
+            out_height=int(mem.height/factor_y)
+
+            # exact resolution, so that the grids of all the tiles are consistent
+            transform=from_origin(mem.transform.c, mem.transform.f, resolution, resolution)
+            im_profile=fct_misc.get_output_profile(src_profile, OUTPUT_OPTIONS, height=out_height, width=out_width, transform=transform)
+            with rasterio.open(os.path.join(directory, filename), 'w', **im_profile) as dst:
+                write_resampled(mem, dst, factor_x, factor_y, window_size, resampling)
+                fct_misc.build_overviews(dst, OUTPUT_OPTIONS)
+
+
+def filter_tile(tile):
+    bands=range(1,5)
+    thresholds={1: None, 2: None, 3: None, 4: 130, 5: 0.05}
 
-logger.info('Defining constants...')
-
-ORIGINAL_ORTHO=cfg['original_ortho']
-FILTER_TYPE=cfg['filter_type']
-
-WORKING_DIR=cfg['working_directory']
-DESTINATION_DIR=cfg['destination_directory']
-
-TILE_DELIMITATION=cfg['tile_delimitation']
-
-INPUTS=cfg['inputs']
-ORTHO_DIR=INPUTS['ortho_directory']
-NDVI_DIR =INPUTS['ndvi_directory']
-
-os.chdir(WORKING_DIR)
-_ = fct_misc.ensure_dir_exists(DESTINATION_DIR)
-
-logger.info('Reading file...')
-tiles=gpd.read_file(TILE_DELIMITATION)
+    if FILTER_TYPE=='gaussian':
+        gaussian_filter_tile(tile.path_RGB, os.path.join(DESTINATION_DIR, tile.NAME + '.tif'), bands,
+                             sigma=5, window_size=GAUSSIAN_WINDOW_SIZE)
+        return
 
-if ORIGINAL_ORTHO:
-    tiles=fct_misc.get_ortho_tiles(tiles, ORTHO_DIR, NDVI_DIR)
-else:
-    ORTHO_DIR=cfg['ortho_directory']
-    tiles['path_RGB']=[os.path.join(ORTHO_DIR, name + '_filtered.tif')  for name in tiles['NAME'].values]
 
-bands=range(1,5)
-thresholds={1: None, 2: None, 3: None, 4: 130, 5: 0.05}
-for tile in tqdm(tiles.itertuples(), desc='Filtering tiles', total=tiles.shape[0]):
-        
-    if FILTER_TYPE in ['gaussian', 'thresholds', 'sieve']:
+    elif FILTER_TYPE=='thresholds':
+        # Threshold based on the images of the script `stats_beeches_pixels.py`
+        # Only the nir band and the NDVI are used, the red band is read only if the NDVI must be calculated.
+        ndvi_from_rgb=not hasattr(tile, 'path_NDVI')
         with rasterio.open(tile.path_RGB) as src:
-            im=src.read(bands)
+            nir_band=src.read(4)
+            red_band=src.read(1) if ndvi_from_rgb else None
             im_profile=src.profile
 
+        high_nir=nir_band > thresholds[4]
 
-    if FILTER_TYPE=='gaussian':
-        filtered_image=im.copy()
-    
-        for band in bands:
-            im_band=im[band-1, :, :]
-            filtered_band=scipy.ndimage.gaussian_filter(im_band, sigma=5)
-            filtered_image[band-1, :, :]=filtered_band
+        if ndvi_from_rgb:
+            high_ndvi=fct_misc.get_ndvi(red_band, nir_band) > thresholds[5]
+            del red_band
+        else:
+            with rasterio.open(tile.path_NDVI) as src:
+                # compare the raw values to the threshold converted with the scale of the NDVI stored as int16
+                high_ndvi=src.read(1) > (thresholds[5] - src.offsets[0])/src.scales[0]
+        del nir_band
 
-        im_profile.update(count = 4)
+        # Hard-coded for the use of 3 cases based on 2 conditions.
+        filtered_image=np.zeros((3, *high_nir.shape), dtype=im_profile['dtype'])
+        filtered_image[0][~(high_nir | high_ndvi)]=255
+        filtered_image[1][high_nir & high_ndvi]=255
+        filtered_image[2][high_nir ^ high_ndvi]=255
 
-
-    elif FILTER_TYPE=='thresholds':
-        # Threshold based on the images of the script `stats_beeches_pixels.py`
-        condition_image=im.copy()
-        filtered_image=im[:3,:,:].copy()
-        nbr_bands=0
-
-        for band in bands:
-            if thresholds[band]:
-                im_band=im[band-1, :, :]
-                condition_band= np.where(im_band>thresholds[band], 255, 0)
-
-                nbr_bands+=1
-                condition_image[nbr_bands-1, :, :]=condition_band
-
-        if thresholds[5]:
-            try:
-                with rasterio.open(tile.path_NDVI) as src:
-                    im_ndvi=src.read(1)
-            except AttributeError as e:
-                if str(e)=="'Pandas' object has no attribute 'path_NDVI'":
-                        red_band=im[0].astype('float32')
-                        nir_band=im[3].astype('float32')
-                        im_ndvi=np.divide((nir_band - red_band),(nir_band + red_band),
-                                            out=np.zeros_like(nir_band - red_band),
-                                            where=(nir_band + red_band)!=0)
-                else:
-                    logger.error(f'AttributeError while oppening the NDVI tile. Message: {str(e)}')
-
-            condition_band=np.where(im_ndvi>thresholds[5], 255, 0)
-            nbr_bands+=1
-            condition_image[nbr_bands-1, :, :]=condition_band
-
-        # Hard-coded for the use of 3 cases based on 2 conditional images.
-        filtered_image[0,:,:]=np.where((condition_image[0,:,:]==0) & (condition_image[1,:,:]==0), 255, 0)
-        filtered_image[1,:,:]=np.where((condition_image[0,:,:]==255) & (condition_image[1,:,:]==255), 255, 0)
-        filtered_image[2,:,:]=np.where(condition_image[0,:,:]!=condition_image[1,:,:], 255, 0)
-
-        filtered_image=filtered_image[:3,:,:]
         im_profile.update(count = 3)
 
 
     elif FILTER_TYPE=='sieve':
         # This filter actually puts a condition before applying the sieve filter in the goal of extacting the branches with
         # exclusively the use of the RGB branches.
+        with rasterio.open(tile.path_RGB) as src:
+            im=src.read([1, 2, 3])
+            im_profile=src.profile
 
-        condition_band=np.where(im[0,:,:]<150, 0,
-                                np.where(im[1,:,:]<150, 0,
-                                         np.where(im[2,:,:]<150, 0, 1)))
-        
-        tilepath=os.path.join(DESTINATION_DIR, 'temp_'+tile.NAME+'_condition.tif')
-        im_profile.update(count= 1)
-        with rasterio.open(tilepath, 'w', **im_profile) as dst:
-                dst.write(condition_band[np.newaxis, ...])
-        
-        conditional_im = gdal.Open(tilepath, 1)  # open image in read-write mode
+        condition_band=((im[0,:,:]>=150) & (im[1,:,:]>=150) & (im[2,:,:]>=150)).astype('uint8')
+
+        # Sieve filter on an in-memory dataset
+        conditional_im = gdal.GetDriverByName('MEM').Create('', condition_band.shape[1], condition_band.shape[0], 1, gdal.GDT_Byte)
         band = conditional_im.GetRasterBand(1)
+        band.WriteArray(condition_band)
         gdal.SieveFilter(srcBand=band, maskBand=None, dstBand=band, threshold=50, connectedness=8)
 
-        arr = band.ReadAsArray()
-        del conditional_im
+        arr = band.ReadAsArray().astype(bool)
+        del band, conditional_im
 
-        condition_band=binary_dilation(arr, iterations=20)
+        # Equivalent to 20 iterations of binary_dilation with the default cross-shaped structuring element
+        if arr.any():
+            condition_band=distance_transform_cdt(~arr, metric='taxicab')<=20
+        else:
+            condition_band=arr
 
-        with rasterio.open(os.path.join(DESTINATION_DIR, tile.NAME+'_filtered.tif'), 'w', **im_profile) as dst:
-            dst.write(condition_band, 1)
+        im_profile.update(count= 1)
+        with rasterio.open(os.path.join(DESTINATION_DIR, tile.NAME+'_filtered.tif'), 'w',
+                           **fct_misc.get_output_profile(im_profile, OUTPUT_OPTIONS)) as dst:
+            dst.write(condition_band.astype('uint8'), 1)
+            fct_misc.build_overviews(dst, OUTPUT_OPTIONS, Resampling.nearest)
 
-        os.remove(tilepath)
-        continue
+        return
 
     elif FILTER_TYPE=='downsampling':
-        scale=1/3.3
-        
-        with rasterio.open(tile.path_RGB) as dataset:
-            # resample data to target shape
-            filtered_image = dataset.read(
-                out_shape=(
-                    dataset.count,
-                    int(dataset.height * scale),
-                    int(dataset.width * scale)
-                ),
-                resampling=Resampling.bilinear
-            )
-
-            im_profile = dataset.profile.copy()
-            # scale image transform
-            transform = dataset.transform * dataset.transform.scale(
-                (dataset.width / filtered_image.shape[-1]),
-                (dataset.height / filtered_image.shape[-2])
-            )
-        
-        im_profile.update({"height": filtered_image.shape[-2],
-            "width": filtered_image.shape[-1],
-            "transform": transform})
-
-    else:
-        logger.error('This type of filter is not implemented.'+
-                    ' Only "gaussian", "downsampling", "sieve" and "threshold" are supported.')
-        sys.exit(1)
+        downsample_tile(tile.path_RGB, os.path.join(DESTINATION_DIR, tile.NAME + '.tif'), scale=1/3.3,
+                        window_size=DOWNSAMPLING_WINDOW_SIZE, use_overviews=USE_OVERVIEWS)
+        return
+
+    elif FILTER_TYPE=='pyramid':
+        pyramid_tile(tile.path_RGB, tile.NAME + '.tif', PYRAMID, window_size=DOWNSAMPLING_WINDOW_SIZE)
+        return
+
 
     tilepath=os.path.join(DESTINATION_DIR, tile.NAME + '.tif') #_filtered.tif
-    with rasterio.open(tilepath, 'w', **im_profile) as dst:
+    with rasterio.open(tilepath, 'w', **fct_misc.get_output_profile(im_profile, OUTPUT_OPTIONS)) as dst:
             dst.write(filtered_image)
+            fct_misc.build_overviews(dst, OUTPUT_OPTIONS, Resampling.nearest if FILTER_TYPE=='thresholds' else Resampling.average)
+
+
+if __name__ == "__main__":
+
+    logger=fct_misc.format_logger(logger)
+    tic = time.time()
+    logger.info('Starting...')
+
+    logger.info(f"Using config.yaml as config file.")
+    with open('config/config_ImPro.yaml') as fp:
+            cfg = yaml.load(fp, Loader=yaml.FullLoader)['filter_images.py']
+
+    logger.info('Defining constants...')
+
+    ORIGINAL_ORTHO=cfg['original_ortho']
+    FILTER_TYPE=cfg['filter_type']
+
+    WORKING_DIR=cfg['working_directory']
+    DESTINATION_DIR=cfg['destination_directory']
+
+    TILE_CATALOG=cfg['tile_catalog']
+
+    OUTPUT_OPTIONS=cfg['output_profile']
+    N_JOBS=cfg['n_jobs'] if cfg['n_jobs'] else os.cpu_count()
+    GAUSSIAN_WINDOW_SIZE=cfg['gaussian_window_size']
+    DOWNSAMPLING_WINDOW_SIZE=cfg['downsampling_window_size']
+    USE_OVERVIEWS=cfg['use_overviews']
+    PYRAMID=cfg['pyramid']
+
+    os.chdir(WORKING_DIR)
+    _ = fct_misc.ensure_dir_exists(DESTINATION_DIR)
+    if FILTER_TYPE=='pyramid':
+        for directory in PYRAMID.values():
+            _ = fct_misc.ensure_dir_exists(directory)
+
+    logger.info('Reading file...')
+    tiles=fct_misc.read_tile_catalog(TILE_CATALOG)
+
+    if not ORIGINAL_ORTHO:
+        # The NDVI of the original tiles does not correspond to the filtered tiles.
+        tiles['path_RGB']=tiles['path_filtered']
+        tiles.drop(columns=['path_NDVI'], inplace=True)
+
+    if FILTER_TYPE not in ['gaussian', 'downsampling', 'pyramid', 'sieve', 'thresholds']:
+        logger.error('This type of filter is not implemented.'+
+                    ' Only "gaussian", "downsampling", "pyramid", "sieve" and "threshold" are supported.')
+        sys.exit(1)
+
+    logger.info(f'Filtering tiles with {N_JOBS} processes...')
+    filtered_tiles = Parallel(n_jobs=N_JOBS, return_as='generator')(delayed(filter_tile)(tile) for tile in tiles.itertuples())
+    for _ in tqdm(filtered_tiles, desc='Filtering tiles', total=tiles.shape[0]):
+        pass
 
-logger.success(f'Done! The files were written in {DESTINATION_DIR}.')
\ No newline at end of file
+    logger.success(f'Done! The files were written in {DESTINATION_DIR}.')
\ No newline at end of file
@@ -2,23 +2,135 @@ import os, sys
 import yaml
 import time
 
+import numpy as np
 import geopandas as gpd
 import pandas as pd
+import rasterio
+import pyarrow as pa
+import pyarrow.parquet as pq
+import matplotlib.pyplot as plt
+import matplotlib.cbook as cbook
 
 from loguru import logger
-from glob import glob
+from tqdm import tqdm
 
 sys.path.insert(1, 'scripts')
 import functions.fct_misc as fct_misc
 from functions.fct_stats import pca_procedure
 
+
+HEALTH_STATUS={'sain': '1. sain', 'malade': '2. malade', 'mort': '3. mort'}
+
+
+def format_pixels(pixels):
+    '''
+    Name the bands, calculate the NDVI and format the health status of the pixels with compact data types.
+
+    - pixels: dataframe of the pixels as given by fct_misc.get_pixel_values
+    return: the formatted dataframe.
+    '''
+
+    pixels=pixels.rename(columns={'band1':'Rouge', 'band2':'Vert', 'band3':'Bleu', 'band4':'Proche IR'})
+    pixels['NDVI']=fct_misc.get_ndvi(pixels['Rouge'].to_numpy(), pixels['Proche IR'].to_numpy())
+    pixels['health_status']=pd.Categorical(pixels['health_status'].map(HEALTH_STATUS), categories=HEALTH_STATUS.values())
+
+    return pixels
+
+
+def sample_pixels(sample, pixels, size, rng, by='health_status'):
+    '''
+    Update a stratified random sample of the pixels with the pixels of a new tile.
+    Each pixel gets a random key and the pixels with the smallest keys are kept in each class,
+    which gives the same result as a reservoir sampling over all the tiles.
+
+    - sample: current sample as returned by this function or None for the first tile
+    - pixels: dataframe of the pixels of the new tile
+    - size: number of pixels to keep per class
+    - rng: numpy random generator
+    - by: column with the classes
+    return: the updated sample.
+    '''
+
+    pixels=pixels.assign(sampling_key=rng.random(len(pixels)))
+    if sample is not None:
+        pixels=pd.concat([sample, pixels], ignore_index=True)
+
+    return pixels.sort_values('sampling_key', kind='stable').groupby(by, observed=True).head(size)
+
+
+def get_tile_stats(pixels, features, by='health_status'):
+    '''
+    Get the sums needed to calculate the statistics of the whole population of pixels, tile by tile.
+
+    - pixels: dataframe of the pixels of a tile
+    - features: columns to describe
+    - by: column with the classes
+    return: a dataframe with the count, sum, sum of squares, min and max of each feature per class.
+    '''
+
+    values=pixels[features].astype('float64')
+    grouped=values.groupby(pixels[by], observed=True)
+
+    return pd.concat({'count': grouped.count(), 'sum': grouped.sum(), 'sum_squares': (values**2).groupby(pixels[by], observed=True).sum(),
+                      'min': grouped.min(), 'max': grouped.max()}, axis=1)
+
+
+def get_population_stats(tiles_stats):
+    '''
+    Combine the sums of each tile into the statistics of the whole population of pixels.
+
+    - tiles_stats: list of dataframes as returned by get_tile_stats
+    return: a dataframe with the count, mean, standard deviation, min and max of each feature per class.
+    '''
+
+    all_stats=pd.concat(tiles_stats)
+    count=all_stats['count'].groupby(level=0, observed=True).sum()
+    mean=all_stats['sum'].groupby(level=0, observed=True).sum()/count
+    variance=(all_stats['sum_squares'].groupby(level=0, observed=True).sum() - count*mean**2)/(count - 1)
+
+    return pd.concat({'count': count, 'mean': mean, 'std': np.sqrt(variance.clip(lower=0)),
+                      'min': all_stats['min'].groupby(level=0, observed=True).min(),
+                      'max': all_stats['max'].groupby(level=0, observed=True).max()}, names=['stat'])
+
+
+def plot_boxplots(pixels_path, features, by, title='', figsize=(16,5)):
+    '''
+    Make a boxplot of each feature grouped by class, reading only the values of one feature and one class at a time.
+
+    - pixels_path: path to the parquet file of the pixels
+    - features: columns to plot
+    - by: column with the classes
+    - title: title of the figure
+    - figsize: size of the figure
+    return: the matplotlib figure.
+    '''
+
+    classes=pq.read_table(pixels_path, columns=[by]).column(by).unique().to_pylist()
+    classes=sorted(value for value in classes if value is not None)
+
+    fig, axes=plt.subplots(1, len(features), figsize=figsize)
+    for ax, feature in zip(np.atleast_1d(axes), features):
+        box_stats=[]
+        for value in classes:
+            values=pq.read_table(pixels_path, columns=[feature], filters=[(by, '==', value)]).column(feature).to_numpy()
+            box_stats.extend(cbook.boxplot_stats(values, labels=[value]))
+
+        ax.bxp(box_stats, showfliers=False)
+        ax.set_title(feature)
+        ax.grid(True)
+
+    fig.suptitle(title)
+
+    return fig
+
+
 logger=fct_misc.format_logger(logger)
 
 tic = time.time()
 logger.info('Starting...')
 
-logger.info(f"Using config.yaml as config file.")
-with open('scripts/image_processing/config.yaml') as fp:
+logger.info(f"Using config_ImPro.yaml as config file.")
+with open('config/config_ImPro.yaml') as fp:
         cfg = yaml.load(fp, Loader=yaml.FullLoader)['stats_beeches_pixels.py']
 
 logger.info('Defining constants...')
@@ -27,16 +139,18 @@ WORKING_DIR=cfg['working_directory']
 DESTINATION_DIR=cfg['destination_directory']
 INPUTS=cfg['inputs']
 
-ORTHO_DIR=INPUTS['ortho_directory']
 NORTH_CHM=INPUTS['north_chm']
 SOUTH_CHM=INPUTS['south_chm']
 
-TILE_DELIMITATION=INPUTS['tile_delimitation']
+TILE_CATALOG=INPUTS['tile_catalog']
 
 BEECHES_POLYGONS=INPUTS['beech_file']
 BEECHES_LAYER=INPUTS['beech_layer']
 
 ORIGINAL_ORTHO=cfg['original_ortho']
+SAMPLING=cfg.get('sampling')
+PCA_BATCH_SIZE=cfg.get('pca_batch_size', 1000000)
+RENDER_FIGURES=cfg.get('render_figures', True)
 
 os.chdir(WORKING_DIR)
 written_files=[]
@@ -48,99 +162,99 @@ logger.info('Reading files...')
 
 beeches=gpd.read_file(BEECHES_POLYGONS, layer=BEECHES_LAYER)
 
-tiles_list=glob(ORTHO_DIR)
-
-north_chm=fct_misc.polygonize_binary_raster(NORTH_CHM)
-south_chm=fct_misc.polygonize_binary_raster(SOUTH_CHM)
-chm=pd.concat([north_chm, south_chm])
-del north_chm, south_chm
-
-tiles=gpd.read_file(TILE_DELIMITATION)
+# Only the tiles around the trees are read from the catalog thanks to its spatial index.
+tiles=fct_misc.read_tile_catalog(TILE_CATALOG, bbox=beeches.total_bounds)
 
 logger.info('Formatting pixel values and tiles...')
 
-fct_misc.test_crs(beeches.crs, chm.crs)
-correct_high_beeches=gpd.overlay(beeches, chm)
-correct_high_beeches.drop(columns=['class'], inplace=True)
+# The height filter is applied on the pixels when extracting their values.
+for chm_path in [NORTH_CHM, SOUTH_CHM]:
+    with rasterio.open(chm_path) as src:
+        fct_misc.test_crs(beeches.crs, src.crs)
 
 if ORIGINAL_ORTHO:
-    tiles_south=tiles[tiles['NAME'].str.startswith('258')] # 258 for 2'580'000 X coordinates
-    beeches_south=correct_high_beeches[correct_high_beeches['zone']=='Miecourt']
-    beeches_on_tiles_south=gpd.overlay(beeches_south[['no_arbre', 'etat_sanitaire', 'geometry']],
-                                        tiles_south[['NAME', 'geometry']])
-    beeches_on_tiles_south['filepath']=[os.path.join(ORTHO_DIR, 'South_ortho_JUHE_LV95_NF02_3cm_' + name + '.tif')
-                                            for name in beeches_on_tiles_south['NAME'].values]
-    del tiles_south, beeches_south
-
-    tiles_north=tiles[tiles['NAME'].str.startswith('257')]
-    beeches_north=correct_high_beeches[correct_high_beeches['zone'].str.startswith('Beurnevesi')]
-    beeches_on_tiles_north=gpd.overlay(beeches_north[['no_arbre', 'etat_sanitaire', 'geometry']],
-                                        tiles_north[['NAME', 'geometry']])
-    beeches_on_tiles_north['filepath']=[os.path.join(ORTHO_DIR, 'North_ortho_JUHE_LV95_NF02_3cm_' + name + '.tif')
-                                            for name in beeches_on_tiles_north['NAME'].values]
-    del tiles_north, beeches_north
-
-    pixels_south=pd.DataFrame()
-    for beech in beeches_on_tiles_south.itertuples():
-        pixels=fct_misc.get_pixel_values(beech.geometry, beech.filepath, bands=range(1,5),
-                                        health_status=beech.etat_sanitaire)
-
-        pixels_south=pd.concat([pixels_south, pixels])
-
-    pixels_north=pd.DataFrame()
-    for beech in beeches_on_tiles_north.itertuples():
-        pixels=fct_misc.get_pixel_values(beech.geometry, beech.filepath, bands=range(1,5),
-            health_status=beech.etat_sanitaire)
-
-        pixels_north=pd.concat([pixels_north, pixels])
-
-    pixels_beeches=pd.concat([pixels_north, pixels_south], ignore_index=True)
-    del pixels_north, pixels_south, pixels
+    # The trees of each zone are taken on the tiles of the corresponding acquisition, i.e. of the corresponding CHM.
+    # The tiles are attributed to a CHM by build_tile_catalog.py: both CHMs must be listed in its "chm" parameter.
+    zones={SOUTH_CHM: beeches['zone']=='Miecourt', NORTH_CHM: beeches['zone'].str.startswith('Beurnevesi')}
+    for chm_path in zones.keys():
+        if not (tiles['path_CHM']==chm_path).any():
+            logger.error(f'No tile of the catalog is attributed to the CHM {chm_path}. '+
+                         'Add it to the "chm" parameter of build_tile_catalog.py and build the catalog again.')
+            sys.exit(1)
+    beeches_on_tiles=pd.concat([gpd.overlay(beeches.loc[in_zone, ['no_arbre', 'etat_sanitaire', 'geometry']],
+                                            tiles.loc[tiles['path_CHM']==chm_path, ['NAME', 'path_RGB', 'path_CHM', 'geometry']])
+                                for chm_path, in_zone in zones.items()], ignore_index=True)
+    beeches_on_tiles.rename(columns={'path_RGB': 'filepath'}, inplace=True)
 else:
     beeches_on_tiles=gpd.overlay(beeches[['no_arbre', 'etat_sanitaire', 'geometry']],
-                                        tiles[['NAME', 'geometry']])
-    beeches_on_tiles['filepath']=[os.path.join(ORTHO_DIR, name + '_filtered.tif')
-                                            for name in beeches_on_tiles['NAME'].values]
-    
-    pixels_beeches=pd.DataFrame()
-    for beech in beeches_on_tiles.itertuples():
-        pixels=fct_misc.get_pixel_values(beech.geometry, beech.filepath, bands=range(1,5),
-            health_status=beech.etat_sanitaire)
-
-        pixels_beeches=pd.concat([pixels_beeches, pixels], ignore_index=True)
-
-logger.info('Calculating the NDVI for pixels...')
-pixels_beeches.rename(columns={'band1':'Rouge', 'band2':'Vert', 'band3':'Bleu', 'band4':'Proche IR'}, inplace=True)
-pixels_beeches['NDVI']=(pixels_beeches['Proche IR'].astype('float64')-
-                            pixels_beeches['Rouge'].astype('float64'))/(pixels_beeches['Proche IR'].astype('float64')+
-                                                                            pixels_beeches['Rouge'].astype('float64'))
-
-pixels_beeches.loc[pixels_beeches['health_status']=='sain', 'health_status']='1. sain'
-pixels_beeches.loc[pixels_beeches['health_status']=='malade', 'health_status']='2. malade'
-pixels_beeches.loc[pixels_beeches['health_status']=='mort', 'health_status']='3. mort'
-
-if ORIGINAL_ORTHO:
-    pixels_beeches=pixels_beeches[pixels_beeches['NDVI']<0.90]
-
-logger.info('Making boxplots...')
-boxplots=pixels_beeches.plot.box(by='health_status',
-                            title='Distribution des pixels en fonction de l\'état sanitaire',
-                            figsize=(16,5),
-                            grid=True)
-fig = boxplots[0].get_figure()
-filename=os.path.join(im_path, 'bxplt_distribution_status_health.jpg')
-fig.savefig(filename, bbox_inches='tight')
-written_files.append(filename)
+                                        tiles[['NAME', 'path_filtered', 'geometry']])
+    beeches_on_tiles.rename(columns={'path_filtered': 'filepath'}, inplace=True)
+    beeches_on_tiles['path_CHM']=None
+
+logger.info('Extracting the pixel values and calculating their NDVI...')
+pixels_path=os.path.join(table_path, 'pixels_beeches.parquet')
+writer=None
+tiles_stats=[]
+sample=None
+if SAMPLING:
+    rng=np.random.default_rng(SAMPLING['seed'])
+for filepath, tile_beeches in tqdm(beeches_on_tiles.groupby('filepath'), desc='Extracting pixels'):
+    pixels=fct_misc.get_pixel_values(tile_beeches.geometry.to_list(), filepath, bands=range(1,5),
+                                    chm_path=tile_beeches.path_CHM.iloc[0],
+                                    health_status=tile_beeches.etat_sanitaire.to_numpy())
+    pixels=format_pixels(pixels)
+
+    if ORIGINAL_ORTHO:
+        pixels=pixels[pixels['NDVI']<0.90]
+
+    # Each tile is appended to the file as a row group, so that the pixels are never all in memory.
+    table=pa.Table.from_pandas(pixels, schema=writer.schema if writer else None, preserve_index=False)
+    if writer is None:
+        writer=pq.ParquetWriter(pixels_path, table.schema)
+    writer.write_table(table)
+
+    tiles_stats.append(get_tile_stats(pixels, [column for column in pixels.columns if column!='health_status']))
+    if SAMPLING:
+        sample=sample_pixels(sample, pixels, SAMPLING['pixels_per_class'], rng)
+
+if writer is None:
+    logger.error('No pixel was extracted from the tiles under the beeches.')
+    sys.exit(1)
+
+writer.close()
+written_files.append(pixels_path)
+del writer, table, pixels
+
+filepath=os.path.join(table_path, 'stats_pixels_beeches.csv')
+get_population_stats(tiles_stats).round(3).to_csv(filepath)
+written_files.append(filepath)
+
+features=[column for column in pq.read_schema(pixels_path).names if column!='health_status']
+if RENDER_FIGURES:
+    logger.info('Making boxplots...')
+    fig=plot_boxplots(pixels_path, features, 'health_status',
+                    title='Distribution des pixels en fonction de l\'état sanitaire',
+                    figsize=(16,5))
+    filename=os.path.join(im_path, 'bxplt_distribution_status_health.jpg')
+    fig.savefig(filename, bbox_inches='tight')
+    plt.close(fig)
+    written_files.append(filename)
 
 logger.info('Making PCAs...')
-features = pixels_beeches.columns.tolist()
-features.remove('health_status')
+if SAMPLING:
+    logger.info(f'The PCA is calculated on a sample of at most {SAMPLING["pixels_per_class"]} pixels per health status.')
+    pixels_beeches=sample.drop(columns='sampling_key').reset_index(drop=True)
+    del sample
+else:
+    # The PCA is calculated incrementally on all the pixels, one row group of the parquet file at a time.
+    pixels_beeches=lambda: (row_group.to_pandas() for row_group in pq.ParquetFile(pixels_path).iter_batches(batch_size=PCA_BATCH_SIZE))
 to_describe='health_status'
 
 written_files_pca_pixels=pca_procedure(pixels_beeches, features, to_describe,
                         table_path, im_path, 
                         file_prefix=f'PCA_beeches_',
-                        title_graph='PCA for the values of the pixels on each band and the NDVI')
+                        title_graph='PCA for the values of the pixels on each band and the NDVI',
+                        render_figures=RENDER_FIGURES)
 
 written_files.extend(written_files_pca_pixels)
 